@@ -6,6 +6,8 @@ Objectif :
 - Forcer Blender à écrire TOUS les caches dans un répertoire unique (--cache-dir)
 - Exploiter au maximum les threads CPU via OpenMP (Mantaflow) et mode FIXED
 - Produire un cache_manifest.json pour validation par le pipeline
+  (fichiers produits par ce run ; tout le cache avec --full-manifest)
+  (+ journal cache_manifest.jsonl alimenté après chaque phase de bake)
 - Supporte la reprise : NE PAS supprimer les caches existants par défaut
 
 Interface :
@@ -21,30 +23,70 @@ import json
 import os
 import shutil
 import signal
+import stat as stat_mod
 import sys
+import threading
 import time
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
 
 import bpy
 
+try:
+    import orjson  # optionnel : sérialisation JSON en C
+except ImportError:
+    orjson = None
+
 # ═══════════════════════════════════════════
 # Constantes
 # ═══════════════════════════════════════════
 
 CACHE_SUBDIRS = ("ptcache", "fluids", "rigidbody", "alembic", "geonodes")
+# Types de modifiers portant un point cache (directement ou via leurs surfaces).
+# Tuple : ordre de parcours stable d'un run à l'autre.
+PTCACHE_MOD_TYPES = ("CLOTH", "SOFT_BODY", "DYNAMIC_PAINT")
 RESERVE_THREADS = 2
+# Mantaflow/FLIP passe mal à l'échelle au-delà de ~16 threads (sub-linéaire,
+# voire plus lent sur les machines 32–96 threads) : plafond par défaut du bake fluide
+FLUID_THREADS_CAP = 16
 
 # Extensions de cache attendues par le pipeline (pipeline.py / FrameWatcher)
 CACHE_EXTENSIONS = {'.bphys', '.vdb', '.uni', '.gz', '.png', '.exr', '.abc', '.obj', '.ply'}
+# Journal JSONL écrit au fil du bake (récupérable si le bake est interrompu)
+MANIFEST_JOURNAL = "cache_manifest.jsonl"
+
+# Même liste sans le point, pour comparer directement avec DirEntry.name
+CACHE_EXT_NODOT = frozenset(ext.lstrip('.') for ext in CACHE_EXTENSIONS)
+
+# Cœurs autorisés au démarrage (Linux) : l'affinité est restreinte par phase,
+# il faut pouvoir ré-élargir si la phase suivante utilise plus de threads
+_ALLOWED_CPUS: Optional[List[int]] = (
+    sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+)
+
+# Propriétés disponibles sur PointCache, sondées une seule fois au chargement
+_PC_PROPS = set(bpy.types.PointCache.bl_rna.properties.keys())
+_HAS_DISK = "use_disk_cache" in _PC_PROPS
+_HAS_EXT = "use_external" in _PC_PROPS
+_HAS_LIB = "use_library_path" in _PC_PROPS
 
 # ═══════════════════════════════════════════
 # État global interruption
 # ═══════════════════════════════════════════
 
-_interrupted = False
+# Event plutôt qu'un booléen global : sûr entre threads, et wait(timeout)
+# se réveille immédiatement à l'interruption (pas de polling time.sleep)
+_interrupt_ev = threading.Event()
 _interrupt_count = 0
 
+# Suppressions de dossiers *.trash.* en arrière-plan, attendues en fin de script
+_trash_threads: List[threading.Thread] = []
+
+# Noms des signaux, construits une seule fois (pas d'enum à chaque signal)
+_SIGNAME: Dict[int, str] = (
+    {s.value: s.name for s in signal.Signals} if hasattr(signal, "Signals") else {}
+)
+
 
 # ═══════════════════════════════════════════
 # Logging (stdout uniquement — lu par blender_runner.py)
@@ -67,10 +109,10 @@ def err(msg: str) -> None:
 # ═══════════════════════════════════════════
 
 def _signal_handler(signum: int, frame: Any) -> None:
-    global _interrupted, _interrupt_count
-    _interrupted = True
+    global _interrupt_count
+    _interrupt_ev.set()
     _interrupt_count += 1
-    sig_name = signal.Signals(signum).name if hasattr(signal, "Signals") else str(signum)
+    sig_name = _SIGNAME.get(signum, str(signum))
     warn(f"Signal {sig_name} reçu (#{_interrupt_count})")
     if _interrupt_count >= 3:
         err("3 interruptions → arrêt immédiat")
@@ -119,9 +161,16 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--no-bake-cloth", dest="bake_cloth", action="store_false")
 
     parser.add_argument("--bake-threads", type=int, default=None)
+    parser.add_argument("--bake-threads-fluid", type=int, default=None,
+                        help="Threads pour le bake fluide (défaut : min(bake-threads, "
+                             f"{FLUID_THREADS_CAP}) — Mantaflow sature au-delà)")
+    parser.add_argument("--bake-threads-ptcache", type=int, default=None,
+                        help="Threads pour les point caches (défaut : bake-threads)")
     parser.add_argument("--strict", action="store_true")
     parser.add_argument("--all-scenes", action="store_true")
     parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--full-manifest", action="store_true",
+                        help="Manifest de tout le cache (sinon : fichiers produits par ce run)")
 
     return parser.parse_args(argv)
 
@@ -143,10 +192,17 @@ def verify_blend_loaded() -> bool:
 # ═══════════════════════════════════════════
 
 def setup_cache_directories(cache_root: Path) -> Dict[str, Path]:
+    # Parents créés une seule fois ; ensuite un mkdir par sous-dossier
+    # (sans le stat + remontée de mkdir -p)
+    os.makedirs(cache_root, exist_ok=True)
     dirs: Dict[str, Path] = {}
     for name in CACHE_SUBDIRS:
         d = cache_root / name
-        d.mkdir(parents=True, exist_ok=True)
+        try:
+            os.mkdir(d)
+        except FileExistsError:
+            if not d.is_dir():
+                raise
         dirs[name] = d
     return dirs
 
@@ -155,42 +211,83 @@ def setup_cache_directories(cache_root: Path) -> Dict[str, Path]:
 # Symlink ptcache (fallback pour Blender qui écrit dans blendcache_<stem>)
 # ═══════════════════════════════════════════
 
-def setup_ptcache_symlink(cache_root: Path) -> bool:
+def _remove_tree_in_background(path: Path) -> None:
+    t = threading.Thread(
+        target=shutil.rmtree,
+        args=(str(path),),
+        kwargs={"ignore_errors": True},
+        daemon=True,
+    )
+    t.start()
+    _trash_threads.append(t)
+
+
+def join_trash_threads() -> None:
+    """Attend la fin des suppressions en arrière-plan (Blender ne les attend pas)."""
+    for t in _trash_threads:
+        t.join()
+    _trash_threads.clear()
+
+
+def setup_ptcache_symlink(cache_root: Path, target: Path) -> bool:
     """
     Crée un symlink blendcache_<stem> → <cache_root>/ptcache/
     Blender écrit les ptcache dans blendcache_<blend_stem>/ à côté du .blend.
     Le symlink redirige vers notre répertoire de cache unifié.
+    `target` est le chemin ptcache déjà résolu (calculé une seule fois dans main).
     """
     blend_path = Path(bpy.data.filepath)
     if not blend_path.exists():
         return False
 
     blendcache_dir = blend_path.parent / f"blendcache_{blend_path.stem}"
-    target = cache_root / "ptcache"
 
-    # Vérifier si le symlink existe déjà et pointe au bon endroit
-    if blendcache_dir.is_symlink():
+    # Restes d'une exécution précédente interrompue avant la fin du rmtree
+    for stale in blend_path.parent.glob(f"{blendcache_dir.name}.trash.*"):
+        _remove_tree_in_background(stale)
+
+    # Un seul lstat pour connaître la nature de l'entrée existante
+    try:
+        st = os.lstat(blendcache_dir)
+    except FileNotFoundError:
+        st = None
+    except OSError:
+        return False
+
+    if st is None:
+        pass
+    elif stat_mod.S_ISLNK(st.st_mode):
+        # Vérifier si le symlink pointe au bon endroit : un seul readlink,
+        # résolution complète uniquement si la chaîne diffère (lien relatif…)
         try:
-            if blendcache_dir.resolve() == target.resolve():
+            if os.readlink(blendcache_dir) == str(target):
+                return True
+            if blendcache_dir.resolve() == target:
                 return True
         except OSError:
             pass
         try:
-            blendcache_dir.unlink()
+            os.unlink(blendcache_dir)
         except OSError:
             return False
-
-    # Supprimer si c'est un vrai dossier
-    if blendcache_dir.is_dir() and not blendcache_dir.is_symlink():
+    elif stat_mod.S_ISDIR(st.st_mode):
+        # Supprimer si c'est un vrai dossier (rmdir direct s'il est vide)
         try:
-            shutil.rmtree(str(blendcache_dir), ignore_errors=True)
+            os.rmdir(blendcache_dir)
         except OSError:
-            return False
-
-    # Supprimer si c'est un fichier
-    if blendcache_dir.exists() and not blendcache_dir.is_dir():
+            # Non vide : rename atomique hors du chemin, suppression en
+            # arrière-plan (le bake démarre sans attendre le rmtree)
+            trash = blendcache_dir.with_name(f"{blendcache_dir.name}.trash.{os.getpid()}")
+            try:
+                os.rename(blendcache_dir, trash)
+            except OSError:
+                shutil.rmtree(str(blendcache_dir), ignore_errors=True)
+            else:
+                _remove_tree_in_background(trash)
+    else:
+        # Supprimer si c'est un fichier
         try:
-            blendcache_dir.unlink()
+            os.unlink(blendcache_dir)
         except OSError:
             return False
 
@@ -210,12 +307,14 @@ def setup_ptcache_symlink(cache_root: Path) -> bool:
 def configure_threading(scene: bpy.types.Scene, n_threads: int) -> None:
     """
     Configure le threading Blender.
-    Note : OMP_NUM_THREADS est déjà défini par blender_runner.py dans l'env
-    du subprocess AVANT le lancement. On le remet ici par sécurité mais
-    OpenMP l'a déjà lu au démarrage du processus.
+    Note : OMP_NUM_THREADS, OMP_PROC_BIND et OMP_PLACES sont déjà définis par
+    blender_runner.py dans l'env du subprocess AVANT le lancement. On les
+    remet ici par sécurité mais OpenMP les a déjà lus au démarrage du processus.
+    Threads épinglés (close/cores) : meilleure localité cache pour Mantaflow.
     """
     os.environ["OMP_NUM_THREADS"] = str(n_threads)
-    os.environ.pop("OMP_PROC_BIND", None)
+    os.environ.setdefault("OMP_PROC_BIND", "close")
+    os.environ.setdefault("OMP_PLACES", "cores")
 
     try:
         scene.render.threads_mode = "FIXED"
@@ -223,35 +322,110 @@ def configure_threading(scene: bpy.types.Scene, n_threads: int) -> None:
     except Exception:
         pass
 
-    log(f"Threading configuré : {n_threads} threads, mode=FIXED")
+    pinned = pin_bake_cpus(n_threads)
+    log(
+        f"Threading configuré : {n_threads} threads, mode=FIXED"
+        + (f", cœurs {pinned[0]}-{pinned[-1]}" if pinned else "")
+    )
+
+
+def pin_bake_cpus(n_threads: int) -> Optional[List[int]]:
+    """
+    Épingle tous les threads du processus Blender sur les `n_threads` premiers
+    cœurs autorisés (Linux). Les cœurs restants sont laissés à zstd / l'OS.
+    sched_setaffinity ne vise qu'un thread : on l'applique à chaque tâche de
+    /proc/self/task (les threads créés ensuite héritent du masque).
+    Retourne la liste des cœurs, ou None si non applicable.
+    """
+    if not _ALLOWED_CPUS or not hasattr(os, "sched_setaffinity"):
+        return None
+    cores = _ALLOWED_CPUS[:max(1, n_threads)]
+    try:
+        tids = [int(t) for t in os.listdir("/proc/self/task")]
+    except OSError:
+        tids = [0]
+    mask = set(cores)
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, mask)
+        except OSError:
+            # Thread terminé entre listdir et l'appel, ou refus du noyau
+            pass
+    return cores
+
+
+# ═══════════════════════════════════════════
+# Classification de la scène (un seul parcours RNA)
+# ═══════════════════════════════════════════
+
+def classify_scene(scene: bpy.types.Scene) -> Dict[str, Any]:
+    """
+    Parcourt scene.objects une seule fois et classe les données de cache.
+
+    Retourne :
+      - "modifiers"        : {mod.type: [(obj, mod), ...]}
+      - "particle_systems" : [(obj, index, psys), ...]
+      - "fluid_domains"    : [(obj, mod), ...] (FLUID avec fluid_type DOMAIN)
+    Les références RNA sont conservées pour éviter toute re-recherche.
+    """
+    modifiers: Dict[str, List[Tuple[Any, Any]]] = {}
+    particle_systems: List[Tuple[Any, int, Any]] = []
+    fluid_domains: List[Tuple[Any, Any]] = []
+
+    for obj in scene.objects:
+        for i, psys in enumerate(obj.particle_systems):
+            particle_systems.append((obj, i, psys))
+        # Une seule conversion RNA → liste Python, un seul accès à mod.type
+        mod_list = list(obj.modifiers)
+        if not mod_list:
+            continue
+        for mod in mod_list:
+            mtype = mod.type
+            bucket = modifiers.get(mtype)
+            if bucket is None:
+                bucket = modifiers[mtype] = []
+            bucket.append((obj, mod))
+            if mtype == "FLUID" and getattr(mod, "fluid_type", None) == "DOMAIN":
+                fluid_domains.append((obj, mod))
+
+    return {
+        "modifiers": modifiers,
+        "particle_systems": particle_systems,
+        "fluid_domains": fluid_domains,
+    }
+
+
+def has_point_caches(scene: bpy.types.Scene, classified: Dict[str, Any]) -> bool:
+    """Indique si la scène contient au moins une source de point cache."""
+    if classified["particle_systems"]:
+        return True
+    modifiers = classified["modifiers"]
+    if any(mtype in modifiers for mtype in PTCACHE_MOD_TYPES):
+        return True
+    return getattr(scene, "rigidbody_world", None) is not None
 
 
 # ═══════════════════════════════════════════
 # Configuration des caches — Fluid Domains
 # ═══════════════════════════════════════════
 
-def configure_fluid_domains(scene: bpy.types.Scene, fluids_dir: Path) -> int:
+def configure_fluid_domains(scene: bpy.types.Scene, fluids_dir: Path, classified: Dict[str, Any]) -> int:
     """Redirige tous les fluid domains vers fluids_dir."""
     count = 0
-    for obj in scene.objects:
-        for mod in obj.modifiers:
-            if mod.type != "FLUID":
-                continue
-            if getattr(mod, "fluid_type", None) != "DOMAIN":
-                continue
-            ds = getattr(mod, "domain_settings", None)
-            if ds is None:
-                continue
-            try:
-                ds.cache_directory = str(fluids_dir)
-                if hasattr(ds, "cache_data_format"):
-                    ds.cache_data_format = "OPENVDB"
-                if hasattr(ds, "openvdb_cache_compress_type"):
-                    ds.openvdb_cache_compress_type = "BLOSC"
-                count += 1
-                log(f"  Fluid domain '{obj.name}' → {fluids_dir}")
-            except Exception as e:
-                warn(f"Erreur config fluid '{obj.name}' : {e}")
+    for obj, mod in classified["fluid_domains"]:
+        ds = getattr(mod, "domain_settings", None)
+        if ds is None:
+            continue
+        try:
+            ds.cache_directory = str(fluids_dir)
+            if hasattr(ds, "cache_data_format"):
+                ds.cache_data_format = "OPENVDB"
+            if hasattr(ds, "openvdb_cache_compress_type"):
+                ds.openvdb_cache_compress_type = "BLOSC"
+            count += 1
+            log(f"  Fluid domain '{obj.name}' → {fluids_dir}")
+        except Exception as e:
+            warn(f"Erreur config fluid '{obj.name}' : {e}")
     return count
 
 
@@ -262,11 +436,11 @@ def configure_fluid_domains(scene: bpy.types.Scene, fluids_dir: Path) -> int:
 def _configure_single_point_cache(pc: Any, ptcache_dir: Path) -> bool:
     """Configure un point_cache individuel pour écriture disque."""
     try:
-        if hasattr(pc, "use_disk_cache"):
+        if _HAS_DISK:
             pc.use_disk_cache = True
-        if hasattr(pc, "use_external"):
+        if _HAS_EXT:
             pc.use_external = False
-        if hasattr(pc, "use_library_path"):
+        if _HAS_LIB:
             pc.use_library_path = False
         # Redirection du chemin : Blender 3.x utilise filepath_raw
         # pour les point caches quand use_external est False,
@@ -277,49 +451,58 @@ def _configure_single_point_cache(pc: Any, ptcache_dir: Path) -> bool:
         return False
 
 
-def configure_disk_caches(scene: bpy.types.Scene, ptcache_dir: Path) -> int:
-    """Configure tous les point caches de la scène pour écriture disque."""
-    count = 0
+def configure_disk_caches(scene: bpy.types.Scene, ptcache_dir: Path, classified: Dict[str, Any]) -> List[Any]:
+    """
+    Configure tous les point caches de la scène pour écriture disque.
+    Retourne la liste des point caches configurés (réutilisée après le bake).
+    """
+    configured: List[Any] = []
+    # Références locales : évite les recherches globales/attributs dans les boucles
+    configure = _configure_single_point_cache
+    append = configured.append
+    modifiers = classified["modifiers"]
 
     # Rigid Body World
     rbw = getattr(scene, "rigidbody_world", None)
     if rbw and rbw.point_cache:
-        if _configure_single_point_cache(rbw.point_cache, ptcache_dir):
-            count += 1
-
-    for obj in scene.objects:
-        # Particle Systems
-        for psys in getattr(obj, "particle_systems", []):
-            if psys.point_cache:
-                if _configure_single_point_cache(psys.point_cache, ptcache_dir):
-                    count += 1
-
-        # Modifiers avec point_cache
-        for mod in obj.modifiers:
-            if mod.type in ("CLOTH", "SOFT_BODY"):
-                if mod.point_cache:
-                    if _configure_single_point_cache(mod.point_cache, ptcache_dir):
-                        count += 1
-            elif mod.type == "DYNAMIC_PAINT":
-                canvas = getattr(mod, "canvas_settings", None)
-                if canvas and hasattr(canvas, "canvas_surfaces"):
-                    for surf in canvas.canvas_surfaces:
-                        if surf.point_cache:
-                            if _configure_single_point_cache(surf.point_cache, ptcache_dir):
-                                count += 1
-            elif mod.type != "FLUID" and hasattr(mod, "point_cache") and mod.point_cache:
-                if _configure_single_point_cache(mod.point_cache, ptcache_dir):
-                    count += 1
-
-    log(f"  {count} caches disque configurés")
-    return count
+        if configure(rbw.point_cache, ptcache_dir):
+            append(rbw.point_cache)
+
+    # Particle Systems
+    for obj, i, psys in classified["particle_systems"]:
+        pc = psys.point_cache
+        if pc and configure(pc, ptcache_dir):
+            append(pc)
+
+    # Modifiers avec point_cache : seuls les types concernés sont parcourus
+    for mtype in PTCACHE_MOD_TYPES:
+        entries = modifiers.get(mtype)
+        if not entries:
+            continue
+        if mtype == "DYNAMIC_PAINT":
+            for obj, mod in entries:
+                canvas = mod.canvas_settings
+                if not canvas:
+                    continue
+                for surf in canvas.canvas_surfaces:
+                    pc = surf.point_cache
+                    if pc and configure(pc, ptcache_dir):
+                        append(pc)
+        else:
+            for obj, mod in entries:
+                pc = mod.point_cache
+                if pc and configure(pc, ptcache_dir):
+                    append(pc)
+
+    log(f"  {len(configured)} caches disque configurés")
+    return configured
 
 
 # ═══════════════════════════════════════════
 # Clear caches existants
 # ═══════════════════════════════════════════
 
-def clear_all_caches(scene: bpy.types.Scene) -> None:
+def clear_all_caches(scene: bpy.types.Scene, classified: Dict[str, Any]) -> None:
     """Supprime tous les bakes existants."""
     try:
         bpy.ops.ptcache.free_bake_all()
@@ -327,26 +510,45 @@ def clear_all_caches(scene: bpy.types.Scene) -> None:
     except Exception as e:
         warn(f"  ptcache.free_bake_all() échoué : {e}")
 
-    for obj in scene.objects:
-        for mod in obj.modifiers:
-            if mod.type == "FLUID" and getattr(mod, "fluid_type", None) == "DOMAIN":
-                try:
-                    bpy.context.view_layer.objects.active = obj
-                    bpy.ops.fluid.free_all()
-                    log(f"  fluid.free_all() → OK ({obj.name})")
-                except Exception as e:
-                    warn(f"  fluid.free_all() échoué ({obj.name}) : {e}")
+    domains = classified["fluid_domains"]
+    if not domains:
+        return
+    vl_objects = _bind_scene_context(scene)
+    for obj, mod in domains:
+        try:
+            vl_objects.active = obj
+            bpy.ops.fluid.free_all()
+            log(f"  fluid.free_all() → OK ({obj.name})")
+        except Exception as e:
+            warn(f"  fluid.free_all() échoué ({obj.name}) : {e}")
 
 
 # ═══════════════════════════════════════════
 # Bake — Point Caches (individuel par objet, plus robuste en background)
 # ═══════════════════════════════════════════
 
-def _ensure_context(scene: bpy.types.Scene, obj: bpy.types.Object) -> bool:
+def _bind_scene_context(scene: bpy.types.Scene) -> Any:
+    """
+    Bascule la fenêtre active sur `scene` et retourne view_layer.objects.
+    Résolu une seule fois avant une boucle de bake (au lieu d'une fois par objet).
+    """
+    win = bpy.context.window
+    if win is not None:
+        try:
+            win.scene = scene
+        except Exception as e:
+            warn(f"Impossible d'activer la scène '{scene.name}' : {e}")
+    try:
+        return bpy.context.view_layer.objects
+    except Exception as e:
+        warn(f"View layer indisponible : {e}")
+        return None
+
+
+def _ensure_context(obj: bpy.types.Object, vl_objects: Any) -> bool:
     """Configure le contexte Blender pour un objet (requis par bpy.ops en background)."""
     try:
-        bpy.context.window.scene = scene
-        bpy.context.view_layer.objects.active = obj
+        vl_objects.active = obj
         obj.select_set(True)
         return True
     except Exception as e:
@@ -354,12 +556,18 @@ def _ensure_context(scene: bpy.types.Scene, obj: bpy.types.Object) -> bool:
         return False
 
 
-def bake_point_caches_individual(scene: bpy.types.Scene) -> Tuple[int, int]:
+def bake_point_caches_individual(
+    scene: bpy.types.Scene,
+    classified: Dict[str, Any],
+    point_caches: List[Any],
+) -> Tuple[int, int]:
     """
     Bake les point caches un par un (plus robuste que bake_all en background).
+    `point_caches` : liste retournée par configure_disk_caches.
     Retourne (succès, échecs).
     """
-    if _interrupted:
+    interrupted = _interrupt_ev.is_set
+    if interrupted():
         return 0, 0
 
     successes = 0
@@ -369,18 +577,8 @@ def bake_point_caches_individual(scene: bpy.types.Scene) -> Tuple[int, int]:
     try:
         log(f"  ptcache.bake_all(bake=True)...")
         bpy.ops.ptcache.bake_all(bake=True)
-        # Compter les caches qui ont été baked
-        for obj in scene.objects:
-            for psys in getattr(obj, "particle_systems", []):
-                if psys.point_cache and psys.point_cache.is_baked:
-                    successes += 1
-            for mod in obj.modifiers:
-                if hasattr(mod, "point_cache") and mod.point_cache:
-                    if mod.point_cache.is_baked:
-                        successes += 1
-        rbw = getattr(scene, "rigidbody_world", None)
-        if rbw and rbw.point_cache and rbw.point_cache.is_baked:
-            successes += 1
+        # Compter les caches configurés qui ont été baked (pas de nouveau parcours de scène)
+        successes = sum(1 for pc in point_caches if pc.is_baked)
 
         log(f"  ptcache.bake_all → {successes} caches baked")
         return successes, failures
@@ -390,10 +588,12 @@ def bake_point_caches_individual(scene: bpy.types.Scene) -> Tuple[int, int]:
         warn(f"  Fallback : bake individuel par objet...")
 
     # Fallback : bake individuel
+    vl_objects = _bind_scene_context(scene)
+
     # Rigid Body World
     rbw = getattr(scene, "rigidbody_world", None)
     if rbw and rbw.point_cache:
-        if _interrupted:
+        if interrupted():
             return successes, failures
         try:
             pc = rbw.point_cache
@@ -407,63 +607,61 @@ def bake_point_caches_individual(scene: bpy.types.Scene) -> Tuple[int, int]:
             failures += 1
             warn(f"  Rigid Body World → échec : {e}")
 
-    for obj in scene.objects:
-        if _interrupted:
+    # Particle Systems
+    for obj, i, psys in classified["particle_systems"]:
+        if interrupted():
             return successes, failures
+        if not psys.point_cache or psys.point_cache.is_baked:
+            continue
+        try:
+            if _ensure_context(obj, vl_objects):
+                # Sélectionner le bon particle system index
+                obj.particle_systems.active_index = i
+                bpy.ops.ptcache.bake({"point_cache": psys.point_cache}, bake=True)
+                successes += 1
+                log(f"  Particules '{obj.name}' [{i}] → baked")
+        except Exception as e:
+            failures += 1
+            warn(f"  Particules '{obj.name}' [{i}] → échec : {e}")
 
-        # Particle Systems
-        for i, psys in enumerate(getattr(obj, "particle_systems", [])):
-            if _interrupted:
-                return successes, failures
-            if not psys.point_cache or psys.point_cache.is_baked:
-                continue
-            try:
-                if _ensure_context(scene, obj):
-                    # Sélectionner le bon particle system index
-                    obj.particle_systems.active_index = i
-                    bpy.ops.ptcache.bake({"point_cache": psys.point_cache}, bake=True)
-                    successes += 1
-                    log(f"  Particules '{obj.name}' [{i}] → baked")
-            except Exception as e:
-                failures += 1
-                warn(f"  Particules '{obj.name}' [{i}] → échec : {e}")
-
-        # Modifiers avec point_cache (Cloth, SoftBody, Dynamic Paint)
-        for mod in obj.modifiers:
-            if _interrupted:
+    # Modifiers avec point_cache (Cloth, SoftBody, Dynamic Paint)
+    modifiers = classified["modifiers"]
+    for mtype in PTCACHE_MOD_TYPES:
+        for obj, mod in modifiers.get(mtype, ()):
+            if interrupted():
                 return successes, failures
-            if mod.type == "FLUID":
-                continue  # Géré séparément
-            pc = getattr(mod, "point_cache", None)
-            if not pc or pc.is_baked:
-                continue
-            try:
-                if _ensure_context(scene, obj):
-                    bpy.ops.ptcache.bake({"point_cache": pc}, bake=True)
-                    successes += 1
-                    log(f"  {mod.type} '{obj.name}.{mod.name}' → baked")
-            except Exception as e:
-                failures += 1
-                warn(f"  {mod.type} '{obj.name}.{mod.name}' → échec : {e}")
 
             # Dynamic Paint surfaces
-            if mod.type == "DYNAMIC_PAINT":
+            if mtype == "DYNAMIC_PAINT":
                 canvas = getattr(mod, "canvas_settings", None)
                 if canvas and hasattr(canvas, "canvas_surfaces"):
                     for surf in canvas.canvas_surfaces:
-                        if _interrupted:
+                        if interrupted():
                             return successes, failures
                         spc = getattr(surf, "point_cache", None)
                         if not spc or spc.is_baked:
                             continue
                         try:
-                            if _ensure_context(scene, obj):
+                            if _ensure_context(obj, vl_objects):
                                 bpy.ops.ptcache.bake({"point_cache": spc}, bake=True)
                                 successes += 1
                                 log(f"  DynamicPaint surface '{obj.name}' → baked")
                         except Exception as e:
                             failures += 1
                             warn(f"  DynamicPaint surface '{obj.name}' → échec : {e}")
+                continue
+
+            pc = getattr(mod, "point_cache", None)
+            if not pc or pc.is_baked:
+                continue
+            try:
+                if _ensure_context(obj, vl_objects):
+                    bpy.ops.ptcache.bake({"point_cache": pc}, bake=True)
+                    successes += 1
+                    log(f"  {mtype} '{obj.name}.{mod.name}' → baked")
+            except Exception as e:
+                failures += 1
+                warn(f"  {mtype} '{obj.name}.{mod.name}' → échec : {e}")
 
     return successes, failures
 
@@ -472,25 +670,28 @@ def bake_point_caches_individual(scene: bpy.types.Scene) -> Tuple[int, int]:
 # Bake — Fluid Domains (Mantaflow)
 # ═══════════════════════════════════════════
 
-def bake_fluid_domains(scene: bpy.types.Scene) -> Tuple[int, int]:
+def bake_fluid_domains(scene: bpy.types.Scene, classified: Dict[str, Any]) -> Tuple[int, int]:
     """Bake tous les fluid domains. Retourne (succès, échecs)."""
     successes = 0
     failures = 0
 
-    for obj in scene.objects:
-        for mod in obj.modifiers:
-            if mod.type != "FLUID" or getattr(mod, "fluid_type", None) != "DOMAIN":
-                continue
-            if _interrupted:
-                return successes, failures
-            try:
-                if _ensure_context(scene, obj):
-                    bpy.ops.fluid.bake_all()
-                    successes += 1
-                    log(f"  Fluid domain '{obj.name}' → baked")
-            except Exception as e:
-                failures += 1
-                warn(f"  Fluid domain '{obj.name}' → échec : {e}")
+    domains = classified["fluid_domains"]
+    if not domains:
+        return successes, failures
+    vl_objects = _bind_scene_context(scene)
+
+    interrupted = _interrupt_ev.is_set
+    for obj, mod in domains:
+        if interrupted():
+            return successes, failures
+        try:
+            if _ensure_context(obj, vl_objects):
+                bpy.ops.fluid.bake_all()
+                successes += 1
+                log(f"  Fluid domain '{obj.name}' → baked")
+        except Exception as e:
+            failures += 1
+            warn(f"  Fluid domain '{obj.name}' → échec : {e}")
 
     return successes, failures
 
@@ -499,30 +700,85 @@ def bake_fluid_domains(scene: bpy.types.Scene) -> Tuple[int, int]:
 # Manifest de cache
 # ═══════════════════════════════════════════
 
-def collect_cache_files(cache_root: Path) -> List[Dict[str, Any]]:
-    """Collecte tous les fichiers de cache avec métadonnées."""
-    files = []
-    for f in sorted(cache_root.rglob("*")):
-        if not f.is_file():
-            continue
-        if f.suffix.lower() not in CACHE_EXTENSIONS:
-            continue
-        if f.name == "cache_manifest.json":
-            continue
+def _iter_cache_entries(cache_root: Path, start: Optional[Path] = None):
+    """
+    Parcourt cache_root (ou seulement son sous-dossier `start`) avec os.scandir
+    (pile explicite, sans suivre les symlinks).
+    Produit (chemin_relatif_à_cache_root, stat) pour chaque fichier de cache.
+    Un seul stat par fichier : DirEntry fournit déjà le type via readdir.
+    """
+    root = str(cache_root)
+    prefix_len = len(root) + 1
+    stack = [str(start) if start is not None else root]
+    while stack:
+        current = stack.pop()
         try:
-            stat = f.stat()
-            files.append({
-                "path": str(f.relative_to(cache_root)),
-                "size": stat.st_size,
-                "timestamp": datetime.datetime.fromtimestamp(
-                    stat.st_mtime
-                ).isoformat(),
-            })
+            it = os.scandir(current)
         except OSError:
-            pass
+            continue
+        with it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+                        continue
+                    if not e.is_file(follow_symlinks=False):
+                        continue
+                    _, dot, ext = e.name.rpartition('.')
+                    if not dot or ext.lower() not in CACHE_EXT_NODOT:
+                        continue
+                    if e.name == "cache_manifest.json":
+                        continue
+                    yield e.path[prefix_len:], e.stat(follow_symlinks=False)
+                except OSError:
+                    pass
+
+
+def collect_cache_files(
+    cache_root: Path,
+    since: Optional[float] = None,
+    subdir: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Collecte les fichiers de cache avec métadonnées.
+    `subdir` limite le parcours à un sous-dossier de cache_root,
+    `since` ne garde que les fichiers modifiés depuis ce timestamp.
+    """
+    files: List[Dict[str, Any]] = []
+    for rel, st in _iter_cache_entries(cache_root, subdir):
+        if since is not None and st.st_mtime < since:
+            continue
+        files.append({
+            "path": rel,
+            "size": st.st_size,
+            # time.strftime évite d'allouer un datetime par fichier
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(st.st_mtime)),
+        })
+    # Tri uniquement des fichiers retenus, après filtrage
+    files.sort(key=lambda d: d["path"])
     return files
 
 
+def append_manifest_journal(
+    journal: Any,
+    cache_files: List[Dict[str, Any]],
+    scene_name: str,
+    phase: str,
+) -> None:
+    """Ajoute au journal JSONL une ligne par fichier produit par une phase de bake."""
+    if orjson is not None:
+        lines = [orjson.dumps(dict(f, scene=scene_name, phase=phase)) for f in cache_files]
+    else:
+        lines = [
+            json.dumps(dict(f, scene=scene_name, phase=phase), ensure_ascii=False).encode("utf-8")
+            for f in cache_files
+        ]
+    if lines:
+        # Une seule écriture par phase (journal ouvert en binaire)
+        journal.write(b"\n".join(lines) + b"\n")
+        journal.flush()
+
+
 def write_manifest(
     cache_root: Path,
     scene_name: str,
@@ -532,9 +788,16 @@ def write_manifest(
     errors: List[str],
     duration: float,
     bake_stats: Dict[str, int],
-) -> None:
-    """Écrit le cache_manifest.json."""
-    cache_files = collect_cache_files(cache_root)
+    cache_files: Optional[List[Dict[str, Any]]] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Écrit le cache_manifest.json. Retourne (fichiers_cache, taille_totale).
+    Sans `cache_files`, parcourt tout cache_root (manifest complet).
+    """
+    scope = "run"
+    if cache_files is None:
+        cache_files = collect_cache_files(cache_root)
+        scope = "full"
 
     total_size = sum(f["size"] for f in cache_files)
 
@@ -548,6 +811,7 @@ def write_manifest(
         "status": status,
         "bake_stats": bake_stats,
         "errors": errors,
+        "files_scope": scope,
         "total_cache_size": total_size,
         "file_count": len(cache_files),
         "files": cache_files,
@@ -555,14 +819,20 @@ def write_manifest(
 
     manifest_path = cache_root / "cache_manifest.json"
     try:
-        manifest_path.write_text(
-            json.dumps(manifest, indent=2, ensure_ascii=False),
-            encoding="utf-8",
-        )
+        fd = os.open(manifest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if orjson is not None:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))
+        else:
+            # json.dump écrit directement dans le fichier, sans chaîne intermédiaire
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                json.dump(manifest, fp, indent=2, ensure_ascii=False)
         log(f"Manifest écrit : {manifest_path} ({len(cache_files)} fichiers, {total_size} octets)")
     except Exception as e:
         warn(f"Impossible d'écrire le manifest : {e}")
 
+    return cache_files, total_size
+
 
 # ═══════════════════════════════════════════
 # Point d'entrée principal
@@ -579,6 +849,8 @@ def main() -> int:
 
     cpu_count = os.cpu_count() or 1
     n_threads = args.bake_threads if args.bake_threads else max(1, cpu_count - RESERVE_THREADS)
+    fluid_threads = args.bake_threads_fluid or min(n_threads, FLUID_THREADS_CAP)
+    ptcache_threads = args.bake_threads_ptcache or n_threads
 
     # ── Bannière de démarrage ──
     log("=" * 70)
@@ -586,7 +858,7 @@ def main() -> int:
     log(f"  Fichier .blend: {bpy.data.filepath}")
     log(f"  Cache dir     : {cache_root}")
     log(f"  CPU           : {cpu_count} threads")
-    log(f"  Bake threads  : {n_threads}")
+    log(f"  Bake threads  : {n_threads} (fluid={fluid_threads}, ptcache={ptcache_threads})")
     log(f"  Frame start   : {args.frame_start}")
     log(f"  Frame end     : {args.frame_end}")
     log("=" * 70)
@@ -596,7 +868,8 @@ def main() -> int:
 
     # ── Créer les sous-répertoires de cache ──
     cache_dirs = setup_cache_directories(cache_root)
-    setup_ptcache_symlink(cache_root)
+    ptcache_target = cache_dirs["ptcache"].resolve()
+    setup_ptcache_symlink(cache_root, ptcache_target)
 
     # ── Scènes à traiter ──
     scenes = list(bpy.data.scenes) if args.all_scenes else [bpy.context.scene]
@@ -610,17 +883,24 @@ def main() -> int:
     frame_start = 1
     frame_end = 250
 
+    # Fichiers produits par ce run (path → entrée de manifest)
+    produced: Dict[str, Dict[str, Any]] = {}
+
+    # ── Journal incrémental (append) ──
+    try:
+        journal = open(cache_root / MANIFEST_JOURNAL, "ab")
+    except OSError as e:
+        warn(f"Impossible d'ouvrir le journal du manifest : {e}")
+        journal = None
+
     for scene in scenes:
-        if _interrupted:
+        if _interrupt_ev.is_set():
             break
 
         last_scene_name = scene.name
         log(f"─── Scène : {scene.name} ───")
 
         try:
-            # Threading
-            configure_threading(scene, n_threads)
-
             # Frame range
             if args.frame_start is not None:
                 scene.frame_start = args.frame_start
@@ -630,32 +910,49 @@ def main() -> int:
             frame_end = scene.frame_end
             log(f"  Frame range : {frame_start} → {frame_end}")
 
-            # Configurer les caches disque
-            configure_disk_caches(scene, cache_dirs["ptcache"])
+            # Classifier les objets de la scène une seule fois
+            classified = classify_scene(scene)
+
+            # Configurer les caches disque (rien à parcourir si la scène n'en a pas)
+            point_caches: List[Any] = []
+            if has_point_caches(scene, classified):
+                point_caches = configure_disk_caches(scene, cache_dirs["ptcache"], classified)
 
             # Configurer les fluid domains
-            if args.bake_fluids:
-                n_fluids = configure_fluid_domains(scene, cache_dirs["fluids"])
+            if args.bake_fluids and "FLUID" in classified["modifiers"]:
+                n_fluids = configure_fluid_domains(scene, cache_dirs["fluids"], classified)
                 log(f"  {n_fluids} fluid domain(s) configuré(s)")
 
             # Clear si demandé
             if args.clear_existing:
                 warn("clear-existing activé : suppression des caches existants")
-                clear_all_caches(scene)
+                clear_all_caches(scene, classified)
 
             # ── Bake Point Caches ──
             if args.bake_cloth or args.bake_particles:
                 log(f"[{scene.name}] Bake point caches…")
-                pc_ok, pc_fail = bake_point_caches_individual(scene)
+                configure_threading(scene, ptcache_threads)
+                phase_start = time.time()
+                pc_ok, pc_fail = bake_point_caches_individual(scene, classified, point_caches)
+                new_files = collect_cache_files(cache_root, since=phase_start, subdir=cache_dirs["ptcache"])
+                produced.update((f["path"], f) for f in new_files)
+                if journal:
+                    append_manifest_journal(journal, new_files, scene.name, "ptcache")
                 total_successes += pc_ok
                 total_failures += pc_fail
                 if pc_fail > 0:
                     all_errors.append(f"[{scene.name}] {pc_fail} point cache(s) échoué(s)")
 
             # ── Bake Fluids ──
-            if args.bake_fluids and not _interrupted:
+            if args.bake_fluids and not _interrupt_ev.is_set():
                 log(f"[{scene.name}] Bake fluid domains…")
-                fl_ok, fl_fail = bake_fluid_domains(scene)
+                configure_threading(scene, fluid_threads)
+                phase_start = time.time()
+                fl_ok, fl_fail = bake_fluid_domains(scene, classified)
+                new_files = collect_cache_files(cache_root, since=phase_start, subdir=cache_dirs["fluids"])
+                produced.update((f["path"], f) for f in new_files)
+                if journal:
+                    append_manifest_journal(journal, new_files, scene.name, "fluids")
                 total_successes += fl_ok
                 total_failures += fl_fail
                 if fl_fail > 0:
@@ -667,10 +964,13 @@ def main() -> int:
             all_errors.append(error_msg)
             total_failures += 1
 
+    if journal:
+        journal.close()
+
     # ── Déterminer le statut final ──
     duration = time.time() - start_time
 
-    if _interrupted:
+    if _interrupt_ev.is_set():
         final_status = "interrupted"
     elif total_failures > 0 and total_successes > 0:
         final_status = "partial"
@@ -686,7 +986,7 @@ def main() -> int:
         "total": total_successes + total_failures,
     }
 
-    write_manifest(
+    cache_files, total_size = write_manifest(
         cache_root=cache_root,
         scene_name=last_scene_name or "unknown",
         frame_start=frame_start,
@@ -695,12 +995,12 @@ def main() -> int:
         errors=all_errors,
         duration=duration,
         bake_stats=bake_stats,
+        cache_files=None if args.full_manifest else sorted(
+            produced.values(), key=lambda d: d["path"]
+        ),
     )
 
-    # ── Résumé final ──
-    cache_files = collect_cache_files(cache_root)
-    total_size = sum(f["size"] for f in cache_files)
-
+    # ── Résumé final (réutilise la collecte du manifest) ──
     log("=" * 70)
     log(f"RÉSUMÉ — statut: {final_status.upper()}")
     log(f"  Durée          : {duration:.1f}s")
@@ -715,7 +1015,7 @@ def main() -> int:
     log("=" * 70)
 
     # ── Code de sortie ──
-    if _interrupted:
+    if _interrupt_ev.is_set():
         return 1
     if total_failures > 0 and total_successes == 0:
         return 1
@@ -727,4 +1027,8 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    try:
+        exit_code = main()
+    finally:
+        join_trash_threads()
+    sys.exit(exit_code)
\ No newline at end of file
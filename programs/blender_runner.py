@@ -49,9 +49,14 @@ class BlenderRunner:
         # Environnement avec OMP_NUM_THREADS pour Mantaflow multi-thread
         env = os.environ.copy()
         env["OMP_NUM_THREADS"] = str(Config.BAKE_THREADS)
-        # Pas de binding CPU pour laisser le scheduler optimiser
-        env.pop("OMP_PROC_BIND", None)
-        logger.info(f"OMP_NUM_THREADS={Config.BAKE_THREADS}")
+        # Threads épinglés sur les cœurs : évite les migrations (localité L2/L3)
+        # pendant les longs bakes fluides. Doit être posé avant le démarrage d'OpenMP.
+        env.setdefault("OMP_PROC_BIND", "close")
+        env.setdefault("OMP_PLACES", "cores")
+        logger.info(
+            f"OMP_NUM_THREADS={Config.BAKE_THREADS} "
+            f"OMP_PROC_BIND={env['OMP_PROC_BIND']} OMP_PLACES={env['OMP_PLACES']}"
+        )
 
         try:
             self.process = subprocess.Popen(
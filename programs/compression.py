@@ -3,12 +3,21 @@ compression.py — Compression zstd avec dictionnaire pour cache Blender.
 
 Le dictionnaire capture les motifs récurrents entre frames de simulation,
 améliorant le ratio de compression de x3-5 (sans dict) à x6-10 (avec dict).
+
+Trois conteneurs : tar (défaut), "raw" (BATCH_FORMAT=raw) ou "frames"
+(BATCH_FORMAT=frames, une frame zstd par fichier), détectés automatiquement
+à la décompression.
 """
 
 import io
+import json
 import logging
+import os
+import stat
+import struct
 import tarfile
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
 from typing import List, Optional, Tuple
 
 import zstandard as zstd
@@ -17,14 +26,81 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Le dictionnaire n'a besoin que de préfixes représentatifs des frames
+TRAINING_SAMPLE_MAX_BYTES = 4 * 1024 * 1024
+TRAINING_CORPUS_MAX_BYTES = 64 * 1024 * 1024
+
+# Format de batch "raw" (BATCH_FORMAT=raw) : contenus concaténés + index JSON
+# en fin de flux, sans les en-têtes/padding tar
+RAW_BATCH_MAGIC = b'BLCACHE1'
+_RAW_INDEX_LEN = struct.Struct('<Q')
+
+# Format "frames" (BATCH_FORMAT=frames) : une frame zstd indépendante par
+# fichier (multi_compress_to_buffer, un seul appel C), index JSON
+# [[nom, taille_compressée], ...] en fin de fichier. Pas de flux zstd englobant.
+FRAMES_BATCH_MAGIC = b'BLFRAME1'
+
+BATCH_SUFFIX = {
+    'raw': '.raw.zst',
+    'frames': '.frames.zst',
+}.get(Config.BATCH_FORMAT, '.tar.zst')
+
+
+TRAINING_READ_WORKERS = 8
+
+# Paramètres fastCover explicites (k, d fixés) : pas de recherche des
+# paramètres optimaux, entraînement nettement plus rapide
+FASTCOVER_PARAMS = {'k': 1024, 'd': 8, 'f': 20, 'accel': 3, 'steps': 4}
+
+# Taille des copies tar → disque à l'extraction (défaut tarfile : 16 Ko)
+EXTRACT_COPY_BUFSIZE = 1 << 20
+
+
+def _read_sample_head(path: Path, limit: int) -> bytes:
+    """
+    Lit au plus `limit` octets en tête de fichier.
+    os.pread libère le GIL pendant la lecture (contrairement à une copie mmap),
+    ce qui permet de paralléliser les lectures sur plusieurs threads.
+    """
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        length = min(os.fstat(fd).st_size, limit)
+        if length <= 0:
+            return b''
+        return os.pread(fd, length, 0)
+    finally:
+        os.close(fd)
+
+
+def _safe_read_sample(path: Path) -> bytes:
+    try:
+        return _read_sample_head(path, TRAINING_SAMPLE_MAX_BYTES)
+    except OSError as e:
+        logger.warning(f"Impossible de lire {path}: {e}")
+        return b''
+
+
+def _prepare_dict(dict_data: zstd.ZstdCompressionDict) -> zstd.ZstdCompressionDict:
+    """
+    Digère le dictionnaire une seule fois (CDict au niveau ZSTD_LEVEL),
+    partagé par tous les compresseurs : sinon zstd le recharge à chaque frame.
+    """
+    dict_data.precompute_compress(level=Config.ZSTD_LEVEL)
+    return dict_data
+
 
 class ZstdDictManager:
     """Gère le dictionnaire zstd pour la compression inter-frames."""
 
+    __slots__ = ('_dict_data', '_dict_bytes', '_trained', '_cctx', '_dctx')
+
     def __init__(self):
         self._dict_data: Optional[zstd.ZstdCompressionDict] = None
         self._dict_bytes: Optional[bytes] = None
         self._trained = False
+        # Contextes zstd réutilisés d'un batch à l'autre (usage séquentiel)
+        self._cctx: Optional[zstd.ZstdCompressor] = None
+        self._dctx: Optional[zstd.ZstdDecompressor] = None
 
     @property
     def is_trained(self) -> bool:
@@ -34,8 +110,11 @@ class ZstdDictManager:
     def dict_bytes(self) -> Optional[bytes]:
         return self._dict_bytes
 
-    def train(self, sample_files: List[Path]) -> bool:
-        """Entraîne le dictionnaire sur un ensemble de fichiers d'échantillon."""
+    def train(self, sample_files: List[Path], fast: bool = True) -> bool:
+        """
+        Entraîne le dictionnaire sur un ensemble de fichiers d'échantillon.
+        fast=True : fastCover avec FASTCOVER_PARAMS (sinon recherche complète).
+        """
         if len(sample_files) < Config.ZSTD_MIN_TRAINING_SAMPLES:
             logger.warning(
                 f"Pas assez d'échantillons pour entraîner le dictionnaire "
@@ -43,26 +122,37 @@ class ZstdDictManager:
             )
             return False
 
+        # Lectures en parallèle (I/O), corpus plafonné dans l'ordre des fichiers
         samples: List[bytes] = []
-        for f in sample_files:
-            try:
-                data = f.read_bytes()
-                if len(data) > 0:
-                    samples.append(data)
-            except OSError as e:
-                logger.warning(f"Impossible de lire {f}: {e}")
+        corpus_size = 0
+        workers = min(TRAINING_READ_WORKERS, len(sample_files))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for data in ex.map(_safe_read_sample, sample_files):
+                remaining = TRAINING_CORPUS_MAX_BYTES - corpus_size
+                if not data or remaining <= 0:
+                    continue
+                data = data[:remaining]
+                samples.append(data)
+                corpus_size += len(data)
 
         if len(samples) < Config.ZSTD_MIN_TRAINING_SAMPLES:
             return False
 
         try:
+            params = dict(FASTCOVER_PARAMS, threads=Config.ZSTD_THREADS) if fast else {}
+            # Même niveau que les batches : sinon les paramètres (taille
+            # minimale des correspondances) du dictionnaire ne collent pas
             dict_data = zstd.train_dictionary(
                 Config.ZSTD_DICT_SIZE,
                 samples,
+                level=Config.ZSTD_LEVEL,
+                **params,
             )
-            self._dict_data = dict_data
+            self._dict_data = _prepare_dict(dict_data)
             self._dict_bytes = dict_data.as_bytes()
             self._trained = True
+            self._cctx = None
+            self._dctx = None
             logger.info(
                 f"Dictionnaire zstd entraîné : {len(self._dict_bytes)} octets "
                 f"à partir de {len(samples)} échantillons"
@@ -75,9 +165,11 @@ class ZstdDictManager:
     def load_from_bytes(self, data: bytes) -> bool:
         """Charge un dictionnaire depuis des bytes bruts."""
         try:
-            self._dict_data = zstd.ZstdCompressionDict(data)
+            self._dict_data = _prepare_dict(zstd.ZstdCompressionDict(data))
             self._dict_bytes = data
             self._trained = True
+            self._cctx = None
+            self._dctx = None
             logger.info(f"Dictionnaire zstd chargé : {len(data)} octets")
             return True
         except Exception as e:
@@ -108,93 +200,353 @@ class ZstdDictManager:
             return False
 
     def get_compressor(self) -> zstd.ZstdCompressor:
-        """Retourne un compresseur configuré avec ou sans dictionnaire."""
-        if self._dict_data:
-            return zstd.ZstdCompressor(
-                dict_data=self._dict_data,
-                level=Config.ZSTD_LEVEL,
-            )
-        return zstd.ZstdCompressor(level=Config.ZSTD_LEVEL)
+        """Retourne le compresseur (mis en cache) avec ou sans dictionnaire."""
+        if self._cctx is None:
+            if self._dict_data:
+                self._cctx = zstd.ZstdCompressor(
+                    dict_data=self._dict_data,
+                    level=Config.ZSTD_LEVEL,
+                    threads=Config.ZSTD_THREADS,
+                )
+            else:
+                self._cctx = zstd.ZstdCompressor(
+                    level=Config.ZSTD_LEVEL,
+                    threads=Config.ZSTD_THREADS,
+                )
+        return self._cctx
 
     def get_decompressor(self) -> zstd.ZstdDecompressor:
-        """Retourne un décompresseur configuré avec ou sans dictionnaire."""
-        if self._dict_data:
-            return zstd.ZstdDecompressor(dict_data=self._dict_data)
-        return zstd.ZstdDecompressor()
+        """Retourne le décompresseur (mis en cache) avec ou sans dictionnaire."""
+        if self._dctx is None:
+            if self._dict_data:
+                self._dctx = zstd.ZstdDecompressor(dict_data=self._dict_data)
+            else:
+                self._dctx = zstd.ZstdDecompressor()
+        return self._dctx
 
 
-def compress_batch(
+def _stat_batch_files(
     files: List[Path],
     cache_dir: Path,
-    dict_manager: Optional[ZstdDictManager] = None,
-) -> Tuple[bytes, int]:
-    """
-    Compresse un batch de fichiers en tar.zst.
-    Retourne (données_compressées, taille_brute).
-    """
-    # Créer le tar en mémoire
-    tar_buffer = io.BytesIO()
-    raw_size = 0
-
-    with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
-        for f in files:
-            if not f.exists():
+) -> List[Tuple[Path, str, os.stat_result]]:
+    """Stat unique par fichier : (chemin, nom_relatif, stat) des fichiers réguliers."""
+    entries: List[Tuple[Path, str, os.stat_result]] = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            if not stat.S_ISREG(st.st_mode):
                 continue
+            # Chemin relatif au cache_dir pour la reconstruction
+            entries.append((f, str(f.relative_to(cache_dir)), st))
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            logger.warning(f"Impossible d'ajouter {f} au batch : {e}")
+    return entries
+
+
+def _write_tar_batch(zw, entries: List[Tuple[Path, str, os.stat_result]]) -> int:
+    """Écrit les fichiers en tar flux ('w|') dans zw. Retourne la taille brute."""
+    raw_size = 0
+    with tarfile.open(fileobj=zw, mode='w|') as tar:
+        for f, arcname, st in entries:
+            info = tarfile.TarInfo(name=arcname)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0o644
             try:
-                # Chemin relatif au cache_dir pour la reconstruction
-                arcname = str(f.relative_to(cache_dir))
-                tar.add(str(f), arcname=arcname)
-                raw_size += f.stat().st_size
-            except (OSError, ValueError) as e:
+                with open(f, 'rb') as fp:
+                    tar.addfile(info, fp)
+                raw_size += st.st_size
+            except OSError as e:
                 logger.warning(f"Impossible d'ajouter {f} au tar : {e}")
+    return raw_size
 
-    tar_bytes = tar_buffer.getvalue()
 
-    # Compresser avec zstd
-    if dict_manager and dict_manager.is_trained:
-        compressor = dict_manager.get_compressor()
+def _write_raw_batch(zw, entries: List[Tuple[Path, str, os.stat_result]]) -> int:
+    """
+    Écrit le format "raw" dans zw : magic, contenus concaténés, index JSON
+    [[nom, taille], ...] puis longueur de l'index (u64 LE). Pas d'en-têtes
+    ni de padding 512 octets. Retourne la taille brute.
+    """
+    zw.write(RAW_BATCH_MAGIC)
+    index: List[List] = []
+    raw_size = 0
+    for f, arcname, st in entries:
+        try:
+            with open(f, 'rb') as fp:
+                data = fp.read()
+        except OSError as e:
+            logger.warning(f"Impossible d'ajouter {f} au batch : {e}")
+            continue
+        zw.write(data)
+        index.append([arcname, len(data)])
+        raw_size += len(data)
+    index_bytes = json.dumps(index).encode('utf-8')
+    zw.write(index_bytes)
+    zw.write(_RAW_INDEX_LEN.pack(len(index_bytes)))
+    return raw_size
+
+
+def _compress_frames_batch(
+    compressor: zstd.ZstdCompressor,
+    entries: List[Tuple[Path, str, os.stat_result]],
+    out,
+) -> int:
+    """
+    Compresse chaque fichier en frame zstd indépendante (format "frames")
+    et écrit le conteneur dans `out`. Retourne la taille brute.
+    """
+    names: List[str] = []
+    contents: List[bytes] = []
+    for f, arcname, _ in entries:
+        try:
+            with open(f, 'rb') as fp:
+                contents.append(fp.read())
+        except OSError as e:
+            logger.warning(f"Impossible d'ajouter {f} au batch : {e}")
+            continue
+        names.append(arcname)
+
+    raw_size = sum(len(c) for c in contents)
+    if contents and hasattr(compressor, 'multi_compress_to_buffer'):
+        # Un seul appel C (GIL relâché), CCtx partagé entre tous les fichiers
+        result = compressor.multi_compress_to_buffer(
+            contents, threads=Config.ZSTD_THREADS
+        )
+        frames = [result[i] for i in range(len(result))]
     else:
-        compressor = zstd.ZstdCompressor(level=Config.ZSTD_LEVEL)
+        # Backend cffi : pas de multi_compress_to_buffer
+        frames = [compressor.compress(c) for c in contents]
+    del contents
+
+    index = [[name, len(frame)] for name, frame in zip(names, frames)]
+    index_bytes = json.dumps(index).encode('utf-8')
+    out.write(FRAMES_BATCH_MAGIC)
+    for frame in frames:
+        out.write(frame)
+    out.write(index_bytes)
+    out.write(_RAW_INDEX_LEN.pack(len(index_bytes)))
+    return raw_size
+
+
+def _batch_compressor(dict_manager: Optional[ZstdDictManager]) -> zstd.ZstdCompressor:
+    if dict_manager:
+        return dict_manager.get_compressor()
+    return zstd.ZstdCompressor(
+        level=Config.ZSTD_LEVEL,
+        threads=Config.ZSTD_THREADS,
+    )
+
+
+def _write_batch(
+    out,
+    compressor: zstd.ZstdCompressor,
+    entries: List[Tuple[Path, str, os.stat_result]],
+) -> int:
+    """Écrit le batch compressé (format BATCH_FORMAT) dans `out`. Retourne la taille brute."""
+    if Config.BATCH_FORMAT == 'frames':
+        return _compress_frames_batch(compressor, entries, out)
+
+    # closefd=False : garder `out` ouvert après la fermeture du flux zstd
+    with compressor.stream_writer(out, closefd=False) as zw:
+        if Config.BATCH_FORMAT == 'raw':
+            return _write_raw_batch(zw, entries)
+        return _write_tar_batch(zw, entries)
 
-    compressed = compressor.compress(tar_bytes)
 
-    ratio = raw_size / len(compressed) if len(compressed) > 0 else 1.0
+def _log_batch(raw_size: int, compressed_size: int) -> None:
+    ratio = raw_size / compressed_size if compressed_size > 0 else 1.0
     logger.debug(
-        f"Batch compressé : {raw_size} → {len(compressed)} octets "
+        f"Batch compressé : {raw_size} → {compressed_size} octets "
         f"(ratio x{ratio:.1f})"
     )
 
+
+def compress_batch(
+    files: List[Path],
+    cache_dir: Path,
+    dict_manager: Optional[ZstdDictManager] = None,
+) -> Tuple[bytes, int]:
+    """
+    Compresse un batch de fichiers (tar.zst, ou format "raw"/"frames" selon
+    BATCH_FORMAT).
+    Retourne (données_compressées, taille_brute).
+
+    Le conteneur est écrit en flux directement dans le compresseur zstd :
+    aucune copie intermédiaire des données non compressées en mémoire.
+    """
+    compressor = _batch_compressor(dict_manager)
+    entries = _stat_batch_files(files, cache_dir)
+
+    out = io.BytesIO()
+    raw_size = _write_batch(out, compressor, entries)
+    compressed = out.getvalue()
+    _log_batch(raw_size, len(compressed))
+
     return compressed, raw_size
 
 
+def compress_batch_to_file(
+    files: List[Path],
+    cache_dir: Path,
+    dict_manager: Optional[ZstdDictManager],
+    out_path: Path,
+) -> Tuple[int, int]:
+    """
+    Comme compress_batch, mais écrit directement dans `out_path` : le batch
+    compressé n'est jamais entièrement en mémoire.
+    Retourne (taille_compressée, taille_brute).
+    """
+    compressor = _batch_compressor(dict_manager)
+    entries = _stat_batch_files(files, cache_dir)
+
+    with open(out_path, 'wb') as fp:
+        raw_size = _write_batch(fp, compressor, entries)
+        compressed_size = fp.tell()
+
+    _log_batch(raw_size, compressed_size)
+    return compressed_size, raw_size
+
+
+def _extract_tar_batch(tar_bytes: bytes, output_dir: Path) -> List[Path]:
+    """Extrait les fichiers réguliers d'un tar en mémoire."""
+    extracted: List[Path] = []
+    tar_buffer = io.BytesIO(tar_bytes)
+
+    with tarfile.open(fileobj=tar_buffer, mode='r', copybufsize=EXTRACT_COPY_BUFSIZE) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            # Sécurité : le filtre 'data' rejette chemins absolus, '..',
+            # liens et fichiers spéciaux (Python 3.12+, backporté en 3.8.17+).
+            # Membre rejeté : ignoré (None), le reste du batch est extrait.
+            def _safe_member(member, dest_path):
+                try:
+                    member = tarfile.data_filter(member, dest_path)
+                except tarfile.FilterError as e:
+                    logger.warning(f"Chemin suspect ignoré : {member.name} ({e})")
+                    return None
+                extracted.append(output_dir / member.name)
+                return member
+
+            file_members = (m for m in tar if m.isfile())
+            tar.extractall(path=str(output_dir), members=file_members, filter=_safe_member)
+        else:
+            for member in tar.getmembers():
+                if member.isfile():
+                    # Sécurité : vérifier pas de path traversal
+                    if '..' in member.name or member.name.startswith('/'):
+                        logger.warning(f"Chemin suspect ignoré : {member.name}")
+                        continue
+                    tar.extract(member, path=str(output_dir))
+                    extracted.append(output_dir / member.name)
+
+    return extracted
+
+
+def _extract_raw_batch(payload: bytes, output_dir: Path) -> List[Path]:
+    """Extrait un batch au format "raw" (voir _write_raw_batch)."""
+    view = memoryview(payload)
+    index_end = len(payload) - _RAW_INDEX_LEN.size
+    (index_len,) = _RAW_INDEX_LEN.unpack_from(payload, index_end)
+    index_start = index_end - index_len
+    if index_start < len(RAW_BATCH_MAGIC):
+        raise ValueError("Batch raw corrompu : index hors limites")
+    index = json.loads(bytes(view[index_start:index_end]))
+
+    extracted: List[Path] = []
+    offset = len(RAW_BATCH_MAGIC)
+    for name, size in index:
+        chunk = view[offset:offset + size]
+        offset += size
+        if offset > index_start:
+            raise ValueError("Batch raw corrompu : contenu tronqué")
+        # Sécurité : vérifier pas de path traversal
+        if PurePosixPath(name).is_absolute() or '..' in PurePosixPath(name).parts:
+            logger.warning(f"Chemin suspect ignoré : {name}")
+            continue
+        target = output_dir / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, 'wb') as fp:
+            fp.write(chunk)
+        extracted.append(target)
+
+    return extracted
+
+
+def _extract_frames_batch(
+    data: bytes,
+    output_dir: Path,
+    decompressor: zstd.ZstdDecompressor,
+) -> List[Path]:
+    """Extrait un batch au format "frames" (voir _compress_frames_batch)."""
+    view = memoryview(data)
+    index_end = len(data) - _RAW_INDEX_LEN.size
+    (index_len,) = _RAW_INDEX_LEN.unpack_from(data, index_end)
+    index_start = index_end - index_len
+    if index_start < len(FRAMES_BATCH_MAGIC):
+        raise ValueError("Batch frames corrompu : index hors limites")
+    index = json.loads(bytes(view[index_start:index_end]))
+
+    segments: List[Tuple[int, int]] = []
+    offset = len(FRAMES_BATCH_MAGIC)
+    for _, size in index:
+        segments.append((offset, size))
+        offset += size
+    if offset > index_start:
+        raise ValueError("Batch frames corrompu : contenu tronqué")
+
+    frames = [view[o:o + s] for o, s in segments]
+    if frames and hasattr(decompressor, 'multi_decompress_to_buffer'):
+        result = decompressor.multi_decompress_to_buffer(
+            frames, threads=Config.ZSTD_THREADS
+        )
+        contents = [result[i] for i in range(len(result))]
+    else:
+        contents = [decompressor.decompress(fr) for fr in frames]
+
+    extracted: List[Path] = []
+    for (name, _), content in zip(index, contents):
+        # Sécurité : vérifier pas de path traversal
+        if PurePosixPath(name).is_absolute() or '..' in PurePosixPath(name).parts:
+            logger.warning(f"Chemin suspect ignoré : {name}")
+            continue
+        target = output_dir / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, 'wb') as fp:
+            fp.write(content)
+        extracted.append(target)
+
+    return extracted
+
+
 def decompress_batch(
     data: bytes,
     output_dir: Path,
     dict_manager: Optional[ZstdDictManager] = None,
 ) -> List[Path]:
     """
-    Décompresse un tar.zst dans output_dir.
+    Décompresse un batch (tar.zst, "raw" ou "frames", détecté automatiquement)
+    dans output_dir.
     Retourne la liste des fichiers extraits.
     """
-    if dict_manager and dict_manager.is_trained:
+    if dict_manager:
         decompressor = dict_manager.get_decompressor()
     else:
         decompressor = zstd.ZstdDecompressor()
 
-    tar_bytes = decompressor.decompress(data)
+    if data[:len(FRAMES_BATCH_MAGIC)] == FRAMES_BATCH_MAGIC:
+        extracted = _extract_frames_batch(data, output_dir, decompressor)
+        logger.info(f"Batch décompressé : {len(extracted)} fichiers dans {output_dir}")
+        return extracted
 
-    extracted: List[Path] = []
-    tar_buffer = io.BytesIO(tar_bytes)
+    # decompressobj : les frames produites en flux n'ont pas de taille
+    # de contenu dans l'en-tête (requise par decompress())
+    payload = decompressor.decompressobj().decompress(data)
 
-    with tarfile.open(fileobj=tar_buffer, mode='r') as tar:
-        for member in tar.getmembers():
-            if member.isfile():
-                # Sécurité : vérifier pas de path traversal
-                if '..' in member.name or member.name.startswith('/'):
-                    logger.warning(f"Chemin suspect ignoré : {member.name}")
-                    continue
-                tar.extract(member, path=str(output_dir))
-                extracted.append(output_dir / member.name)
+    if payload.startswith(RAW_BATCH_MAGIC):
+        extracted = _extract_raw_batch(payload, output_dir)
+    else:
+        extracted = _extract_tar_batch(payload, output_dir)
 
     logger.info(f"Batch décompressé : {len(extracted)} fichiers dans {output_dir}")
     return extracted
\ No newline at end of file
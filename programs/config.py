@@ -3,24 +3,24 @@ Configuration pour le script VM — Pipeline 3 threads
 """
 
 import os
+from dataclasses import dataclass, field
 from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Référence directe (load_dotenv a déjà alimenté os.environ)
+_ENV = os.environ
+
 
 def _get_int_env(name, default):
-    val = os.getenv(name)
-    if val is None or val.strip() == "":
-        return default
-    return int(val)
+    val = _ENV.get(name, '').strip()
+    return int(val) if val else default
 
 
 def _get_float_env(name, default):
-    val = os.getenv(name)
-    if val is None or val.strip() == "":
-        return default
-    return float(val)
+    val = _ENV.get(name, '').strip()
+    return float(val) if val else default
 
 
 class Config:
@@ -54,6 +54,15 @@ class Config:
     BATCH_INTERVAL = _get_float_env('BATCH_INTERVAL', 2.0)
 
     ZSTD_LEVEL = _get_int_env('ZSTD_LEVEL', 3)
+    # Compression en parallèle du bake : par défaut, les cœurs laissés libres
+    # par BAKE_THREADS (pas de contention avec Mantaflow/OpenMP)
+    ZSTD_THREADS = _get_int_env(
+        'ZSTD_THREADS',
+        max(1, (os.cpu_count() or 1) - BAKE_THREADS)
+    )
+    # Conteneur des batches : 'tar' (tar.zst), 'raw' (index + contenus concaténés)
+    # ou 'frames' (une frame zstd par fichier)
+    BATCH_FORMAT = os.getenv('BATCH_FORMAT', 'tar').strip().lower() or 'tar'
     ZSTD_DICT_SIZE = _get_int_env('ZSTD_DICT_SIZE', 256 * 1024)
     ZSTD_MIN_TRAINING_SAMPLES = _get_int_env('ZSTD_MIN_TRAINING_SAMPLES', 10)
 
@@ -65,6 +74,10 @@ class Config:
         'S3_MULTIPART_CHUNK_SIZE',
         5 * 1024 * 1024
     )
+    # Parts multipart envoyées en parallèle (et taille du pool HTTP)
+    UPLOAD_CONCURRENCY = _get_int_env('UPLOAD_CONCURRENCY', 8)
+    # Batches uploadés simultanément
+    UPLOAD_INFLIGHT_BATCHES = _get_int_env('UPLOAD_INFLIGHT_BATCHES', 4)
 
     PROGRESS_REPORT_INTERVAL = _get_float_env(
         'PROGRESS_REPORT_INTERVAL',
@@ -84,3 +97,26 @@ class Config:
             )
         cls.ensure_dirs()
         return True
+
+
+@dataclass(frozen=True, slots=True)
+class S3Credentials:
+    """Credentials S3 envoyées par le coordinateur (message S3_CREDENTIALS)."""
+    endpoint: str
+    bucket: str
+    access_key_id: str
+    secret_access_key: str = field(repr=False)  # jamais dans les logs
+    region: str = 'us-east-1'
+    cache_prefix: str = 'cache/'
+
+    @classmethod
+    def from_message(cls, message: dict) -> 'S3Credentials':
+        return cls(
+            endpoint=message.get('endpoint'),
+            bucket=message.get('bucket'),
+            access_key_id=message.get('accessKeyId'),
+            secret_access_key=message.get('secretAccessKey'),
+            # Champs présents mais null : valeurs par défaut
+            region=message.get('region') or 'us-east-1',
+            cache_prefix=message.get('cachePrefix') or 'cache/',
+        )
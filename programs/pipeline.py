@@ -6,14 +6,19 @@ Fix Storj 411: upload HTTP direct avec urllib3 (Content-Length garanti).
 import hashlib
 import io
 import logging
+import mmap
+import os
 import re
 import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from queue import Queue, Empty
-from typing import Dict, List, Optional, Set
-from urllib.parse import urlparse
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+from urllib.parse import quote, urlparse
+from xml.etree import ElementTree
 
 import boto3
 import botocore.auth
@@ -25,32 +30,66 @@ import urllib3
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
 
-from compression import ZstdDictManager, compress_batch
-from config import Config
+from compression import BATCH_SUFFIX, TRAINING_SAMPLE_MAX_BYTES, ZstdDictManager, compress_batch_to_file
+from config import Config, S3Credentials
 from progress import ProgressTracker
 
 logger = logging.getLogger(__name__)
 
-CACHE_EXTENSIONS = {
+CACHE_EXTENSIONS = frozenset({
     '.bphys', '.vdb', '.uni', '.gz',
     '.png', '.exr', '.abc', '.obj', '.ply',
-}
+})
 
-FRAME_PATTERNS = [
-    re.compile(r'_(\d{4,6})_\d+\.bphys$'),
-    re.compile(r'_(\d{4,6})\.bphys$'),
-    re.compile(r'_(\d{4,6})\.vdb$'),
-    re.compile(r'data_(\d{4,6})\.vdb$'),
-    re.compile(r'_(\d+)\.\w+$'),
-]
+# Délai sans écriture avant de considérer un fichier de cache comme complet
+STABLE_DELAY = 0.5
+
+# Demande de flush dans frame_queue : (_FLUSH_REQUEST, threading.Event)
+_FLUSH_REQUEST = object()
+
+# Fenêtre de regroupement des messages PROGRESS_BAKED (secondes)
+BAKED_COALESCE_DELAY = 0.1
+
+# Ticks de progression identiques sautés avant un renvoi complet
+PROGRESS_RESEND_TICKS = 20
+
+# Taille minimale d'une part multipart S3 (hors dernière part)
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Motifs de numéro de frame, fusionnés en une seule alternance (un seul
+# search par nom). Tous ancrés en fin de nom : la correspondance la plus à
+# gauche est celle du premier motif applicable, comme une recherche en série.
+FRAME_PATTERNS = (
+    r'_(\d{4,6})_\d+\.bphys$',
+    r'_(\d{4,6})\.bphys$',
+    r'_(\d{4,6})\.vdb$',
+    r'data_(\d{4,6})\.vdb$',
+    r'_(\d+)\.\w+$',
+)
+_FRAME_RE = re.compile('|'.join(f'(?:{p})' for p in FRAME_PATTERNS))
+
+
+@lru_cache(maxsize=4096)
+def _frame_from_name(name: str) -> Optional[int]:
+    m = _FRAME_RE.search(name)
+    # Un seul groupe participe à la correspondance : lastindex le désigne
+    return int(m.group(m.lastindex)) if m else None
 
 
 def extract_frame_number(filepath: Path) -> Optional[int]:
-    name = filepath.name
-    for pattern in FRAME_PATTERNS:
-        m = pattern.search(name)
-        if m:
-            return int(m.group(1))
+    # Appelé par le watcher puis par le compresseur pour le même fichier
+    return _frame_from_name(filepath.name)
+
+
+def _xml_text(data: bytes, tag: str) -> Optional[str]:
+    """Texte du premier élément `tag` d'une réponse XML S3 (namespace ignoré)."""
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError:
+        return None
+    for el in root.iter():
+        if el.tag == tag or el.tag.endswith('}' + tag):
+            return el.text
     return None
 
 
@@ -69,15 +108,25 @@ class _CacheEventHandler(FileSystemEventHandler):
 
 
 class FrameWatcher:
-    def __init__(self, cache_dir: Path, frame_queue: Queue, progress: ProgressTracker, ws_client, already_secured: Optional[Set[int]] = None):
+    def __init__(self, cache_dir: Path, frame_queue: Queue, progress: ProgressTracker, ws_client, already_secured: Optional[Set[int]] = None, restored_files: Optional[Dict[str, Tuple[int, int]]] = None):
         self.cache_dir = cache_dir
         self.frame_queue = frame_queue
         self.progress = progress
         self.ws_client = ws_client
         self._seen_files: Set[str] = set()
         self._already_secured = already_secured or set()
+        # chemin → (taille, mtime_ns) des fichiers restaurés depuis R2
+        self._restored_files = restored_files or {}
         self._observer: Optional[Observer] = None
         self._stop_event = threading.Event()
+        # Debounce : un timer par fichier en cours d'écriture, relancé à chaque
+        # événement ; le fichier part en file après STABLE_DELAY sans écriture
+        self._pending_stable: Dict[str, threading.Timer] = {}
+        self._pending_lock = threading.Lock()
+        # PROGRESS_BAKED regroupés : un envoi par fenêtre BAKED_COALESCE_DELAY
+        self._pending_baked: List[Tuple[int, float]] = []
+        self._baked_timer: Optional[threading.Timer] = None
+        self._baked_lock = threading.Lock()
 
     def start(self):
         self.cache_dir.mkdir(parents=True, exist_ok=True)
@@ -92,16 +141,59 @@ class FrameWatcher:
         if self._observer:
             self._observer.stop()
             self._observer.join(timeout=5)
+        with self._pending_lock:
+            timers = list(self._pending_stable.values())
+            self._pending_stable.clear()
+        for timer in timers:
+            timer.cancel()
+        with self._baked_lock:
+            if self._baked_timer is not None:
+                self._baked_timer.cancel()
+        if self.ws_client:
+            self._flush_baked()
+
+    def flush_pending(self):
+        """Met en file immédiatement les fichiers encore en attente de debounce."""
+        with self._pending_lock:
+            pending = list(self._pending_stable.items())
+            self._pending_stable.clear()
+        for key, timer in pending:
+            timer.cancel()
+            self._emit_stable(Path(key), extract_frame_number(Path(key)), timer)
 
     def _scan_existing(self):
-        for ext in CACHE_EXTENSIONS:
-            for fp in self.cache_dir.rglob(f'*{ext}'):
-                if fp.is_file():
-                    self._process_file(fp, initial=True)
+        # Un seul parcours scandir (au lieu d'un rglob par extension) ;
+        # DirEntry.is_file() réutilise le type renvoyé par readdir
+        stack = [str(self.cache_dir)]
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+                        if not entry.is_file():
+                            continue
+                    except OSError:
+                        continue
+                    name = entry.name
+                    dot = name.rfind('.')
+                    if dot >= 0 and name[dot:].lower() in CACHE_EXTENSIONS:
+                        self._process_file(Path(entry.path), initial=True)
 
     def _on_file(self, path: Path):
         if path.suffix.lower() not in CACHE_EXTENSIONS:
             return
+        key = str(path)
+        if key in self._seen_files:
+            # Écriture en cours : repousser la mise en file
+            if key in self._pending_stable:
+                self._schedule_stable(path, extract_frame_number(path))
+            return
         self._process_file(path, initial=False)
 
     def _process_file(self, path: Path, initial: bool):
@@ -112,40 +204,88 @@ class FrameWatcher:
 
         frame = extract_frame_number(path)
         if frame is not None:
+            # Plusieurs fichiers par frame : n'annoncer la frame qu'une fois
+            is_new = frame not in self.progress.baked_frames
             self.progress.register_baked_frame(frame)
-            if not initial and self.ws_client and self.ws_client.is_connected():
-                self.ws_client.send_threadsafe({
-                    'type': 'PROGRESS_BAKED',
-                    'frame': frame,
-                    'total': self.progress.total_frames,
-                    'timestamp': time.time(),
-                })
+            if is_new and not initial and self.ws_client:
+                self._queue_baked(frame)
             if frame in self._already_secured:
                 return
 
-        if not initial and not self._wait_stable(path):
-            return
-
-        self.frame_queue.put(path)
-
-    def _wait_stable(self, path: Path, timeout: float = 3.0) -> bool:
-        last_size = -1
-        waited = 0.0
-        while waited < timeout:
+        restored = self._restored_files.get(key)
+        if restored is not None:
             try:
-                size = path.stat().st_size
-                if size == last_size and size > 0:
-                    return True
-                last_size = size
+                st = path.stat()
             except OSError:
-                return False
-            time.sleep(0.3)
-            waited += 0.3
-        return last_size > 0
+                return
+            # Restauré depuis R2 et non réécrit depuis : déjà sécurisé
+            if (st.st_size, st.st_mtime_ns) == restored:
+                return
+
+        if not initial:
+            self._schedule_stable(path, frame)
+            return
+
+        self.frame_queue.put((path, frame))
+
+    def _queue_baked(self, frame: int):
+        with self._baked_lock:
+            self._pending_baked.append((frame, time.time()))
+            if self._baked_timer is None:
+                self._baked_timer = threading.Timer(BAKED_COALESCE_DELAY, self._flush_baked)
+                self._baked_timer.daemon = True
+                self._baked_timer.start()
+
+    def _flush_baked(self):
+        with self._baked_lock:
+            pending = self._pending_baked
+            self._pending_baked = []
+            self._baked_timer = None
+        if not pending or not self.ws_client.is_connected():
+            return
+        total = self.progress.total_frames
+        self.ws_client.send_many_threadsafe([
+            {
+                'type': 'PROGRESS_BAKED',
+                'frame': frame,
+                'total': total,
+                'timestamp': ts,
+            }
+            for frame, ts in pending
+        ])
+
+    def _schedule_stable(self, path: Path, frame: Optional[int]):
+        key = str(path)
+        with self._pending_lock:
+            if self._stop_event.is_set():
+                return
+            timer = self._pending_stable.get(key)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(STABLE_DELAY, self._emit_stable, args=(path, frame))
+            timer.daemon = True
+            self._pending_stable[key] = timer
+            timer.start()
+
+    def _emit_stable(self, path: Path, frame: Optional[int], timer: Optional[threading.Timer] = None):
+        key = str(path)
+        if timer is None:
+            # Appel par le timer : ignorer s'il a été remplacé entre-temps
+            with self._pending_lock:
+                current = self._pending_stable.get(key)
+                if current is None or current is not threading.current_thread():
+                    return
+                del self._pending_stable[key]
+        try:
+            if path.stat().st_size <= 0:
+                return
+        except OSError:
+            return
+        self.frame_queue.put((path, frame))
 
 
 class BatchCompressor:
-    def __init__(self, cache_dir: Path, frame_queue: Queue, batch_queue: Queue, progress: ProgressTracker, dict_manager: ZstdDictManager, ws_client, work_dir: Path):
+    def __init__(self, cache_dir: Path, frame_queue: Queue, batch_queue: Queue, progress: ProgressTracker, dict_manager: ZstdDictManager, ws_client, work_dir: Path, on_dict_trained: Optional[Callable[[bytes], None]] = None):
         self.cache_dir = cache_dir
         self.frame_queue = frame_queue
         self.batch_queue = batch_queue
@@ -154,10 +294,16 @@ class BatchCompressor:
         self.ws_client = ws_client
         self.work_dir = work_dir
 
-        self._pending_files: List[Path] = []
-        self._pending_frames: List[int] = []
+        # (chemin, frame ou None) : le numéro de frame vient du watcher
+        self._pending: List[Tuple[Path, Optional[int]]] = []
         self._dict_training_samples: List[Path] = []
+        # Budget d'échantillons en octets (~100× la taille du dictionnaire)
+        # plutôt qu'en nombre de fichiers : les .vdb peuvent faire plusieurs Mo
+        self._training_bytes = 0
+        self._training_budget = 100 * Config.ZSTD_DICT_SIZE
         self._dict_trained = False
+        self._dict_training = False
+        self._on_dict_trained = on_dict_trained
 
         self._thread: Optional[threading.Thread] = None
         self._stop_event = threading.Event()
@@ -187,72 +333,119 @@ class BatchCompressor:
         optimal = (speed * Config.TARGET_UPLOAD_TIME) / compressed_per_frame
         self.batch_size = max(Config.MIN_BATCH_SIZE, min(Config.MAX_BATCH_SIZE, int(optimal)))
 
-    def flush(self):
-        if self._pending_files:
-            self._compress_batch()
+    def flush(self, timeout: float) -> bool:
+        """
+        Compresse les fichiers restants, y compris ceux déjà mis en file.
+        La demande passe par frame_queue : traitée par le thread compresseur
+        (seul propriétaire de _pending) après tous les fichiers qui la précèdent.
+        Retourne True si le flush est terminé avant `timeout`.
+        """
+        done = threading.Event()
+        self.frame_queue.put((_FLUSH_REQUEST, done))
+        return done.wait(timeout)
+
+    def _take(self, item: Tuple):
+        fp, frame = item
+        if fp is _FLUSH_REQUEST:
+            # frame : Event du demandeur
+            try:
+                if self._pending:
+                    self._compress_batch()
+            finally:
+                frame.set()
+            return
+        self._add_file(fp, frame)
 
     def _run(self):
         while not self._stop_event.is_set():
             try:
                 try:
-                    fp = self.frame_queue.get(timeout=Config.BATCH_INTERVAL)
-                    self._add_file(fp)
+                    self._take(self.frame_queue.get(timeout=Config.BATCH_INTERVAL))
                 except Empty:
                     pass
 
                 while not self.frame_queue.empty():
                     try:
-                        fp = self.frame_queue.get_nowait()
-                        self._add_file(fp)
+                        item = self.frame_queue.get_nowait()
                     except Empty:
                         break
+                    self._take(item)
 
-                if len(self._pending_files) >= self.batch_size:
+                if len(self._pending) >= self.batch_size:
                     self._compress_batch()
             except Exception as e:
                 logger.error(f"Compressor error: {e}", exc_info=True)
                 time.sleep(1.0)
 
-        if self._pending_files:
+        if self._pending:
             self._compress_batch()
 
-    def _add_file(self, path: Path):
-        self._pending_files.append(path)
-        frame = extract_frame_number(path)
-        if frame is not None:
-            self._pending_frames.append(frame)
-        if not self._dict_trained and len(self._dict_training_samples) < 30:
+    def _train_and_publish(self, samples: List[Path]):
+        try:
+            if self.dict_manager.train(samples):
+                self.dict_manager.save_to_file(Config.DICT_FILE)
+                self._dict_trained = True
+                # Publier tout de suite : une VM de reprise en a besoin pour
+                # décompresser les batches produits avec ce dictionnaire
+                if self._on_dict_trained:
+                    self._on_dict_trained(self.dict_manager.dict_bytes)
+        except Exception as e:
+            logger.error(f"Erreur entraînement dictionnaire : {e}", exc_info=True)
+        finally:
+            self._dict_training = False
+
+    def _add_file(self, path: Path, frame: Optional[int]):
+        self._pending.append((path, frame))
+        if not self._dict_trained and (
+            self._training_bytes < self._training_budget
+            or len(self._dict_training_samples) < Config.ZSTD_MIN_TRAINING_SAMPLES
+        ):
+            try:
+                size = path.stat().st_size
+            except OSError:
+                return
             self._dict_training_samples.append(path)
+            # train() ne lit qu'un préfixe de chaque échantillon
+            self._training_bytes += min(size, TRAINING_SAMPLE_MAX_BYTES)
 
     def _compress_batch(self):
-        if not self._pending_files:
+        if not self._pending:
             return
 
-        if not self._dict_trained and len(self._dict_training_samples) >= Config.ZSTD_MIN_TRAINING_SAMPLES:
-            if self.dict_manager.train(self._dict_training_samples):
-                self.dict_manager.save_to_file(Config.DICT_FILE)
-                self._dict_trained = True
-
-        files = self._pending_files[:]
-        frames = self._pending_frames[:]
-        self._pending_files.clear()
-        self._pending_frames.clear()
+        if (not self._dict_trained and not self._dict_training
+                and len(self._dict_training_samples) >= Config.ZSTD_MIN_TRAINING_SAMPLES):
+            # Entraînement hors du thread de compression : les batches
+            # continuent (sans dictionnaire) pendant ce temps
+            self._dict_training = True
+            threading.Thread(
+                target=self._train_and_publish,
+                args=(list(self._dict_training_samples),),
+                daemon=True,
+                name="DictTrain",
+            ).start()
+
+        pending = self._pending
+        self._pending = []
+        files = [path for path, _ in pending]
+        frames = [frame for _, frame in pending if frame is not None]
 
         batch = self.progress.create_batch(frames)
-        compressed, raw_size = compress_batch(files, self.cache_dir, self.dict_manager)
-
-        self.progress.register_compressed(batch.batch_id, len(compressed), raw_size)
-
         self.work_dir.mkdir(parents=True, exist_ok=True)
-        batch_file = self.work_dir / f"batch_{batch.batch_id:04d}.tar.zst"
-        batch_file.write_bytes(compressed)
+        batch_file = self.work_dir / f"batch_{batch.batch_id:04d}{BATCH_SUFFIX}"
+        # Compression en flux directement vers le disque : le batch compressé
+        # n'est jamais entièrement en mémoire
+        compressed_size, raw_size = compress_batch_to_file(
+            files, self.cache_dir, self.dict_manager, batch_file
+        )
+
+        self.progress.register_compressed(batch.batch_id, compressed_size, raw_size)
 
         if self.ws_client and self.ws_client.is_connected():
             self.ws_client.send_threadsafe({
                 'type': 'PROGRESS_COMPRESSED',
                 'frames': frames,
                 'batchId': batch.batch_id,
-                'compressedSize': int(batch_file.stat().st_size),
+                'compressedSize': int(compressed_size),
                 'rawSize': int(raw_size),
                 'timestamp': time.time(),
             })
@@ -264,110 +457,163 @@ class BatchCompressor:
 class StorjUploader:
     """Upload HTTP direct vers Storj avec signature AWS v4 et Content-Length garanti."""
 
-    def __init__(self, endpoint: str, access_key: str, secret_key: str, bucket: str, region: str = 'us-east-1'):
+    def __init__(self, endpoint: str, access_key: str, secret_key: str, bucket: str, region: str = 'us-east-1', max_connections: int = 4):
         self._endpoint = endpoint.rstrip('/')
         self._bucket = bucket
         self._region = region
         self._credentials = botocore.credentials.Credentials(access_key, secret_key)
         self._signer = botocore.auth.SigV4Auth(self._credentials, 's3', self._region)
+        # Une connexion par part en vol (uploads multipart concurrents)
         self._http = urllib3.PoolManager(
             num_pools=4,
-            maxsize=4,
+            maxsize=max(4, max_connections),
             retries=urllib3.Retry(total=3, backoff_factor=1.0),
         )
         parsed = urlparse(self._endpoint)
         self._host = parsed.netloc
 
-    def put_object(self, key: str, data: bytes, content_type: str = 'application/octet-stream', metadata: Optional[Dict[str, str]] = None) -> Dict:
-        """PUT un objet avec Content-Length explicite."""
+    def _send(self, method: str, key: str, query: str = '', body: bytes = b'', headers: Optional[Dict[str, str]] = None):
+        """Signe (SigV4) et envoie une requête sur l'objet `key`."""
         url = f"{self._endpoint}/{self._bucket}/{key}"
-        content_sha256 = hashlib.sha256(data).hexdigest()
+        if query:
+            url = f"{url}?{query}"
 
-        headers = {
+        all_headers = {
             'Host': self._host,
-            'Content-Type': content_type,
-            'Content-Length': str(len(data)),
-            'x-amz-content-sha256': content_sha256,
+            'x-amz-content-sha256': hashlib.sha256(body).hexdigest(),
             'x-amz-date': datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
         }
-
-        if metadata:
-            for k, v in metadata.items():
-                headers[f'x-amz-meta-{k}'] = v
+        if method in ('PUT', 'POST'):
+            all_headers['Content-Length'] = str(len(body))
+        if headers:
+            all_headers.update(headers)
 
         # Signer la requête
         request = botocore.awsrequest.AWSRequest(
-            method='PUT',
+            method=method,
             url=url,
-            headers=headers,
-            data=data,
+            headers=all_headers,
+            data=body,
         )
         self._signer.add_auth(request)
 
         # Envoyer
-        response = self._http.urlopen(
-            'PUT',
+        return self._http.urlopen(
+            method,
             url,
-            body=data,
+            body=body if method in ('PUT', 'POST') else None,
             headers=dict(request.headers),
             preload_content=True,
         )
 
+    @staticmethod
+    def _check(response, what: str) -> None:
         if response.status not in (200, 201, 204):
             raise Exception(
-                f"Storj PUT failed: HTTP {response.status} — {response.data.decode('utf-8', errors='replace')[:500]}"
+                f"Storj {what} failed: HTTP {response.status} — {response.data.decode('utf-8', errors='replace')[:500]}"
             )
 
+    def put_object(self, key: str, data: bytes, content_type: str = 'application/octet-stream', metadata: Optional[Dict[str, str]] = None) -> Dict:
+        """PUT un objet avec Content-Length explicite."""
+        headers = {'Content-Type': content_type}
+        if metadata:
+            for k, v in metadata.items():
+                headers[f'x-amz-meta-{k}'] = v
+
+        response = self._send('PUT', key, body=data, headers=headers)
+        self._check(response, 'PUT')
+
         return {
             'ETag': response.headers.get('ETag', '').strip('"'),
             'status': response.status,
         }
 
-    def head_object(self, key: str) -> Dict:
-        """HEAD un objet."""
-        url = f"{self._endpoint}/{self._bucket}/{key}"
-
-        headers = {
-            'Host': self._host,
-            'x-amz-content-sha256': hashlib.sha256(b'').hexdigest(),
-            'x-amz-date': datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
-        }
+    def put_object_multipart(self, key: str, data: Union[bytes, mmap.mmap], part_size: int, executor: ThreadPoolExecutor, content_type: str = 'application/octet-stream', metadata: Optional[Dict[str, str]] = None) -> Dict:
+        """
+        Upload multipart : les parts (chacune avec Content-Length explicite)
+        sont envoyées en parallèle sur `executor`. Annule l'upload en cas d'échec.
+        """
+        headers = {'Content-Type': content_type}
+        if metadata:
+            for k, v in metadata.items():
+                headers[f'x-amz-meta-{k}'] = v
 
-        request = botocore.awsrequest.AWSRequest(
-            method='HEAD',
-            url=url,
-            headers=headers,
-        )
-        self._signer.add_auth(request)
+        response = self._send('POST', key, query='uploads', headers=headers)
+        self._check(response, 'CreateMultipartUpload')
+        upload_id = _xml_text(response.data, 'UploadId')
+        if not upload_id:
+            raise Exception("Storj CreateMultipartUpload : UploadId absent de la réponse")
+        upload_query = f"uploadId={quote(upload_id, safe='')}"
 
-        response = self._http.urlopen(
-            'HEAD',
-            url,
-            headers=dict(request.headers),
-            preload_content=True,
-        )
+        futures: List[Future] = []
+        try:
+            # (offset, taille) seulement : la part n'est copiée (tranche de
+            # l'mmap) qu'au moment de son envoi, dans le thread du pool
+            futures = [
+                executor.submit(self._upload_part, key, upload_query, number, data, offset, part_size)
+                for number, offset in enumerate(range(0, len(data), part_size), start=1)
+            ]
+            etags = [f.result() for f in futures]
+
+            parts = ''.join(
+                f'<Part><PartNumber>{number}</PartNumber><ETag>"{etag}"</ETag></Part>'
+                for number, etag in enumerate(etags, start=1)
+            )
+            body = f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode('utf-8')
+            response = self._send('POST', key, query=upload_query, body=body, headers={'Content-Type': 'application/xml'})
+            self._check(response, 'CompleteMultipartUpload')
+            # Une erreur peut être renvoyée avec un statut 200
+            if _xml_text(response.data, 'Code'):
+                raise Exception(
+                    f"Storj CompleteMultipartUpload failed: {response.data.decode('utf-8', errors='replace')[:500]}"
+                )
+        except BaseException:
+            # Parts pas encore démarrées : inutile de les envoyer
+            for f in futures:
+                f.cancel()
+            wait(futures)
+            try:
+                self._send('DELETE', key, query=upload_query)
+            except Exception as e:
+                logger.warning(f"Échec annulation multipart {key}: {e}")
+            raise
 
         return {
-            'ETag': response.headers.get('ETag', '').strip('"'),
-            'ContentLength': int(response.headers.get('Content-Length', 0)),
+            'ETag': (_xml_text(response.data, 'ETag') or '').strip('"'),
             'status': response.status,
         }
 
+    def _upload_part(self, key: str, upload_query: str, number: int, data: Union[bytes, mmap.mmap], offset: int, length: int) -> str:
+        """PUT la part data[offset:offset + length] ; retourne son ETag."""
+        chunk = data[offset:offset + length]
+        response = self._send('PUT', key, query=f"partNumber={number}&{upload_query}", body=chunk)
+        self._check(response, f'UploadPart #{number}')
+        return response.headers.get('ETag', '').strip('"')
+
 
 class BatchUploader:
-    def __init__(self, batch_queue: Queue, progress: ProgressTracker, s3_credentials: Dict, ws_client, cache_prefix: str):
+    def __init__(self, batch_queue: Queue, progress: ProgressTracker, s3_credentials: S3Credentials, ws_client, cache_prefix: str, max_concurrency: int = Config.UPLOAD_CONCURRENCY, max_inflight: int = Config.UPLOAD_INFLIGHT_BATCHES):
         self.batch_queue = batch_queue
         self.progress = progress
         self.ws_client = ws_client
         self.cache_prefix = cache_prefix
 
         self._storj = StorjUploader(
-            endpoint=s3_credentials['endpoint'],
-            access_key=s3_credentials['accessKeyId'],
-            secret_key=s3_credentials['secretAccessKey'],
-            bucket=s3_credentials['bucket'],
-            region=s3_credentials.get('region', 'us-east-1'),
+            endpoint=s3_credentials.endpoint,
+            access_key=s3_credentials.access_key_id,
+            secret_key=s3_credentials.secret_access_key,
+            bucket=s3_credentials.bucket,
+            region=s3_credentials.region,
+            max_connections=max_concurrency,
         )
+        # Pool partagé entre batches pour les parts multipart
+        self._part_pool = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="UplPart")
+        self._part_size = max(S3_MIN_PART_SIZE, Config.S3_MULTIPART_CHUNK_SIZE)
+        # Plusieurs batches en vol : un batch lent ne bloque plus les suivants
+        self._max_inflight = max(1, max_inflight)
+        self._inflight = threading.BoundedSemaphore(self._max_inflight)
+        self._batch_pool = ThreadPoolExecutor(max_workers=self._max_inflight, thread_name_prefix="Upl")
+        self._futures: Set[Future] = set()
         self._thread: Optional[threading.Thread] = None
         self._stop_event = threading.Event()
 
@@ -377,10 +623,25 @@ class BatchUploader:
 
     def stop(self):
         self._stop_event.set()
+        # Sentinelle : réveille _run bloqué sur get()
+        self.batch_queue.put(None)
         if self._thread:
             self._thread.join(timeout=30)
-
-    def upload_dict(self, dict_bytes: bytes, work_dir: Path):
+        # Laisser finir les uploads en vol
+        wait(list(self._futures), timeout=30)
+        self._batch_pool.shutdown(wait=False)
+        self._part_pool.shutdown(wait=False)
+
+    def wait_idle(self, timeout: float) -> bool:
+        """
+        Attend que tous les batches mis en file soient traités (uploadés ou
+        échoués). Retourne True si c'est le cas avant `timeout`.
+        """
+        queue = self.batch_queue
+        with queue.all_tasks_done:
+            return queue.all_tasks_done.wait_for(lambda: not queue.unfinished_tasks, timeout)
+
+    def upload_dict(self, dict_bytes: bytes, work_dir: Path) -> bool:
         key = f"{self.cache_prefix}dictionary.zstd"
         try:
             self._storj.put_object(
@@ -389,36 +650,65 @@ class BatchUploader:
                 metadata={'type': 'zstd-dictionary'},
             )
             self._notify_secured(frames=[], batch_id=0, r2_key=key, upload_speed_bps=int(self.progress.upload_speed_bps))
+            return True
         except Exception as e:
             logger.error(f"Erreur upload dictionnaire: {e}", exc_info=True)
+            return False
 
     def _run(self):
-        while not self._stop_event.is_set():
+        while True:
+            # Réserver une place avant de retirer le batch de la file
+            self._inflight.acquire()
+            item = self.batch_queue.get()
+            if item is None or self._stop_event.is_set():
+                self._inflight.release()
+                self.batch_queue.task_done()
+                break
+            batch_id, batch_file, frames = item
             try:
-                batch_id, batch_file, frames = self.batch_queue.get(timeout=1.0)
-                self._upload_batch(batch_id, batch_file, frames)
-            except Empty:
-                continue
+                future = self._batch_pool.submit(self._upload_batch, batch_id, batch_file, frames)
             except Exception as e:
+                self._inflight.release()
+                self.batch_queue.task_done()
                 logger.error(f"Uploader error: {e}", exc_info=True)
                 time.sleep(1.0)
+                continue
+            self._futures.add(future)
+            future.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, future: Future):
+        self._futures.discard(future)
+        self._inflight.release()
+        self.batch_queue.task_done()
+        exc = future.exception()
+        if exc is not None:
+            logger.error(f"Uploader error: {exc}", exc_info=exc)
 
     def _upload_batch(self, batch_id: int, batch_file: Path, frames: List[int]):
-        key = f"{self.cache_prefix}batch_{batch_id:04d}.tar.zst"
+        key = f"{self.cache_prefix}batch_{batch_id:04d}{BATCH_SUFFIX}"
         start = time.time()
 
         try:
-            data = batch_file.read_bytes()
-
-            result = self._storj.put_object(
-                key=key,
-                data=data,
-                metadata={
-                    'batch-id': str(batch_id),
-                    'frames': ','.join(str(f) for f in frames),
-                    'frame-count': str(len(frames)),
-                },
-            )
+            metadata = {
+                'batch-id': str(batch_id),
+                'frames': ','.join(str(f) for f in frames),
+                'frame-count': str(len(frames)),
+            }
+            with open(batch_file, 'rb') as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size > max(Config.S3_MULTIPART_THRESHOLD, self._part_size):
+                    # mmap : seules les parts en cours sont copiées en mémoire
+                    # (tranches bytes, Content-Length explicite pour Storj)
+                    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        result = self._storj.put_object_multipart(
+                            key=key,
+                            data=mm,
+                            part_size=self._part_size,
+                            executor=self._part_pool,
+                            metadata=metadata,
+                        )
+                else:
+                    result = self._storj.put_object(key=key, data=fp.read(), metadata=metadata)
 
             duration = time.time() - start
             self.progress.register_secured(batch_id, key, duration)
@@ -430,7 +720,7 @@ class BatchUploader:
                 batch_id=batch_id,
                 r2_key=key,
                 upload_speed_bps=int(self.progress.upload_speed_bps),
-                size=len(data),
+                size=size,
                 etag=etag,
             )
 
@@ -462,11 +752,11 @@ class BatchUploader:
 
 
 class Pipeline:
-    def __init__(self, cache_dir: Path, ws_client, s3_credentials: Dict, total_frames: int = 250, already_secured: Optional[Set[int]] = None, dict_bytes: Optional[bytes] = None, work_dir: Optional[Path] = None):
+    def __init__(self, cache_dir: Path, ws_client, s3_credentials: S3Credentials, total_frames: int = 250, already_secured: Optional[Set[int]] = None, dict_bytes: Optional[bytes] = None, work_dir: Optional[Path] = None, restored_files: Optional[Dict[str, Tuple[int, int]]] = None):
         self.cache_dir = cache_dir
         self.ws_client = ws_client
         self.s3_credentials = s3_credentials
-        self.cache_prefix = s3_credentials.get('cachePrefix', 'cache/')
+        self.cache_prefix = s3_credentials.cache_prefix
 
         self.work_dir = work_dir or (Path(__file__).parent / 'work' / 'batches')
         self._frame_queue: Queue = Queue()
@@ -480,12 +770,13 @@ class Pipeline:
         elif Config.DICT_FILE.exists():
             self.dict_manager.load_from_file(Config.DICT_FILE)
 
-        self.watcher = FrameWatcher(cache_dir, self._frame_queue, self.progress, ws_client, already_secured)
-        self.compressor = BatchCompressor(cache_dir, self._frame_queue, self._batch_queue, self.progress, self.dict_manager, ws_client, self.work_dir)
+        self.watcher = FrameWatcher(cache_dir, self._frame_queue, self.progress, ws_client, already_secured, restored_files)
+        self.compressor = BatchCompressor(cache_dir, self._frame_queue, self._batch_queue, self.progress, self.dict_manager, ws_client, self.work_dir, on_dict_trained=self._publish_dict)
         self.uploader = BatchUploader(self._batch_queue, self.progress, s3_credentials, ws_client, self.cache_prefix)
 
         self._stop_event = threading.Event()
         self._progress_thread: Optional[threading.Thread] = None
+        self._dict_published = False
 
     def start(self):
         self.watcher.start()
@@ -503,22 +794,28 @@ class Pipeline:
             self._progress_thread.join(timeout=5)
 
     def finalize(self):
-        self.compressor.flush()
-        timeout = 120.0
-        waited = 0.0
-        while not self._batch_queue.empty() and waited < timeout:
-            time.sleep(0.5)
-            waited += 0.5
-        if self.dict_manager.is_trained and self.dict_manager.dict_bytes:
+        self.watcher.flush_pending()
+        # Après flush() : le dernier batch est déjà dans batch_queue
+        if not self.compressor.flush(timeout=120.0):
+            logger.warning("Flush du compresseur non terminé avant le délai")
+        # Réveillé par task_done() dès le dernier batch traité
+        self.uploader.wait_idle(timeout=120.0)
+        if self.dict_manager.is_trained and self.dict_manager.dict_bytes and not self._dict_published:
             self.uploader.upload_dict(self.dict_manager.dict_bytes, self.work_dir)
 
+    def _publish_dict(self, dict_bytes: bytes):
+        """Upload du dictionnaire dès la fin de l'entraînement."""
+        if self.uploader.upload_dict(dict_bytes, self.work_dir):
+            self._dict_published = True
+
     def _progress_loop(self):
-        while not self._stop_event.is_set():
-            time.sleep(Config.PROGRESS_REPORT_INTERVAL)
+        last_sent: Optional[Dict] = None
+        skipped = 0
+        while not self._stop_event.wait(Config.PROGRESS_REPORT_INTERVAL):
             status = self.progress.get_status_dict()
             status['currentBatchSize'] = self.compressor.batch_size
             if self.ws_client and self.ws_client.is_connected():
-                self.ws_client.send_threadsafe({
+                msg = {
                     'type': 'PROGRESS_UPDATE',
                     'uploadPercent': int(status['securedPercent']),
                     'diskBytes': 0,
@@ -528,4 +825,12 @@ class Pipeline:
                     'errors': 0,
                     'rateBytesPerSec': int(status['uploadSpeedBps']),
                     'progress': status,
-                })
+                }
+                # État inchangé depuis le dernier envoi : ne rien renvoyer,
+                # sauf un rappel complet toutes les PROGRESS_RESEND_TICKS
+                if msg == last_sent and skipped < PROGRESS_RESEND_TICKS:
+                    skipped += 1
+                    continue
+                self.ws_client.send_threadsafe(msg)
+                last_sent = msg
+                skipped = 0
@@ -8,9 +8,11 @@ Trois niveaux :
 """
 
 import logging
+import threading
 import time
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Set
+from typing import Deque, Dict, List, Optional, Set
 
 logger = logging.getLogger(__name__)
 
@@ -37,10 +39,22 @@ class ProgressTracker:
         self.baked_frames: Set[int] = set()
         self.compressed_frames: Set[int] = set()
         self.secured_frames: Set[int] = set(already_secured or set())
+        # Maxima tenus à jour à l'ajout (les deux sets ne font que croître) :
+        # last_baked_frame / last_secured_frame en O(1) à chaque tick
+        self._last_baked = 0
+        self._last_secured = max(self.secured_frames, default=0)
 
         # Batches
         self.batches: Dict[int, BatchInfo] = {}
         self._next_batch_id = 1
+        # 10 derniers batches créés (ids croissants) : pas de tri à chaque tick
+        self._recent_batches: Deque[BatchInfo] = deque(maxlen=10)
+        # Somme des tailles compressées par frame des batches confirmés (ETA)
+        self._confirmed_per_frame_sum = 0.0
+        self._confirmed_count = 0
+        # Protège _recent_batches, _last_secured et les cumuls ETA : écrits par le
+        # compresseur et plusieurs threads d'upload, lus par le thread de progression
+        self._lock = threading.Lock()
 
         # Métriques
         self.upload_speed_bps: float = 0.0
@@ -48,7 +62,7 @@ class ProgressTracker:
         self.baking_speed_fps: float = 0.0
 
         # Pour calcul vitesse de bake
-        self._bake_count_window: List[float] = []
+        self._bake_count_window: Deque[float] = deque()
         self._last_bake_time: float = time.time()
 
     # ── Propriétés de progression ──
@@ -73,11 +87,12 @@ class ProgressTracker:
 
     @property
     def last_baked_frame(self) -> int:
-        return max(self.baked_frames) if self.baked_frames else 0
+        return self._last_baked
 
     @property
     def last_secured_frame(self) -> int:
-        return max(self.secured_frames) if self.secured_frames else 0
+        with self._lock:
+            return self._last_secured
 
     # ── ETA ──
 
@@ -96,12 +111,12 @@ class ProgressTracker:
         if remaining <= 0:
             return 0.0
         # Estimation basée sur la taille compressée moyenne par frame
-        confirmed = [b for b in self.batches.values() if b.status == 'confirmed']
-        if not confirmed or self.upload_speed_bps <= 0:
+        with self._lock:
+            count = self._confirmed_count
+            per_frame_sum = self._confirmed_per_frame_sum
+        if not count or self.upload_speed_bps <= 0:
             return remaining * 2.0  # estimation grossière
-        avg_compressed_per_frame = sum(
-            b.compressed_size / max(len(b.frames), 1) for b in confirmed
-        ) / len(confirmed)
+        avg_compressed_per_frame = per_frame_sum / count
         total_remaining_bytes = remaining * avg_compressed_per_frame
         return total_remaining_bytes / self.upload_speed_bps
 
@@ -110,15 +125,20 @@ class ProgressTracker:
     def register_baked_frame(self, frame: int):
         """Enregistre qu'une frame a été calculée par Blender."""
         self.baked_frames.add(frame)
+        if frame > self._last_baked:
+            self._last_baked = frame
         now = time.time()
-        self._bake_count_window.append(now)
+        window = self._bake_count_window
+        window.append(now)
         # Garder une fenêtre de 5 secondes pour calculer la vitesse
+        # (horodatages croissants : on ne retire que par la gauche)
         cutoff = now - 5.0
-        self._bake_count_window = [t for t in self._bake_count_window if t > cutoff]
-        if len(self._bake_count_window) >= 2:
-            elapsed = self._bake_count_window[-1] - self._bake_count_window[0]
+        while window[0] <= cutoff:
+            window.popleft()
+        if len(window) >= 2:
+            elapsed = window[-1] - window[0]
             if elapsed > 0:
-                self.baking_speed_fps = (len(self._bake_count_window) - 1) / elapsed
+                self.baking_speed_fps = (len(window) - 1) / elapsed
 
     def create_batch(self, frames: List[int]) -> BatchInfo:
         """Crée un nouveau batch."""
@@ -128,6 +148,8 @@ class ProgressTracker:
             status='compressing',
         )
         self.batches[batch.batch_id] = batch
+        with self._lock:
+            self._recent_batches.append(batch)
         self._next_batch_id += 1
         return batch
 
@@ -156,6 +178,11 @@ class ProgressTracker:
         batch.r2_key = r2_key
         batch.upload_duration = upload_duration
         batch.status = 'confirmed'
+        with self._lock:
+            self._confirmed_per_frame_sum += batch.compressed_size / max(len(batch.frames), 1)
+            self._confirmed_count += 1
+            if batch.frames:
+                self._last_secured = max(self._last_secured, max(batch.frames))
         self.secured_frames.update(batch.frames)
         # Mettre à jour la vitesse d'upload
         if upload_duration > 0 and batch.compressed_size > 0:
@@ -173,11 +200,8 @@ class ProgressTracker:
 
     def get_status_dict(self) -> dict:
         """Retourne un dict complet pour envoi via WebSocket."""
-        recent_batches = sorted(
-            self.batches.values(),
-            key=lambda b: b.batch_id,
-            reverse=True,
-        )[:10]
+        with self._lock:
+            recent_batches = list(reversed(self._recent_batches))
 
         return {
             'totalFrames': self.total_frames,
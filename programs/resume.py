@@ -9,34 +9,75 @@ Quand une nouvelle VM prend le relais, elle doit :
 """
 
 import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from queue import Empty, Full, LifoQueue
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import boto3
 from botocore.config import Config as BotoConfig
 
 from compression import ZstdDictManager, decompress_batch
+from config import S3Credentials
 from utils import format_bytes
 
 logger = logging.getLogger(__name__)
 
+# Téléchargements de batches en parallèle (client boto3 partagé, thread-safe)
+DOWNLOAD_WORKERS = 8
+# Tampons de téléchargement réutilisés (batches plus gros : allocation dédiée)
+DOWNLOAD_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class BufferPool:
+    """
+    Réserve de bytearray de taille fixe réutilisés d'un téléchargement à
+    l'autre (pages déjà allouées, pas de réallocation par batch).
+    get() ne bloque jamais : réserve vide → nouveau tampon.
+    """
+
+    def __init__(self, size: int, count: int):
+        self.size = size
+        self._free: LifoQueue = LifoQueue(maxsize=count)
+
+    def get(self) -> bytearray:
+        try:
+            return self._free.get_nowait()
+        except Empty:
+            return bytearray(self.size)
+
+    def put(self, buf: bytearray) -> None:
+        try:
+            self._free.put_nowait(buf)
+        except Full:
+            pass  # Réserve pleine : laisser le tampon au GC
+
 
 class ResumeManager:
     """Gère la reprise de cache depuis R2 pour une nouvelle VM."""
 
-    def __init__(self, s3_credentials: Dict):
+    def __init__(self, s3_credentials: S3Credentials):
         self._s3 = boto3.client(
             's3',
-            endpoint_url=s3_credentials['endpoint'],
-            aws_access_key_id=s3_credentials['accessKeyId'],
-            aws_secret_access_key=s3_credentials['secretAccessKey'],
-            region_name=s3_credentials.get('region', 'us-east-1'),
+            endpoint_url=s3_credentials.endpoint,
+            aws_access_key_id=s3_credentials.access_key_id,
+            aws_secret_access_key=s3_credentials.secret_access_key,
+            region_name=s3_credentials.region,
             config=BotoConfig(
                 signature_version='s3v4',
                 retries={'max_attempts': 3, 'mode': 'adaptive'},
+                # Une connexion réutilisable par téléchargement en vol
+                # (défaut botocore : 10, soit des connexions jetées au-delà)
+                max_pool_connections=DOWNLOAD_WORKERS * 2,
+                tcp_keepalive=True,
             ),
         )
-        self._bucket = s3_credentials['bucket']
+        self._bucket = s3_credentials.bucket
+        # Fichiers restaurés : chemin → (taille, mtime_ns) après extraction.
+        # Déjà sécurisés dans R2 : inutile de les recompresser tant qu'inchangés.
+        self.restored_files: Dict[str, Tuple[int, int]] = {}
 
     def download_dictionary(self, dict_key: str, output_path: Path) -> Optional[bytes]:
         """Télécharge le dictionnaire zstd depuis R2."""
@@ -59,6 +100,7 @@ class ResumeManager:
         batch_keys: List[str],
         cache_dir: Path,
         dict_manager: Optional[ZstdDictManager] = None,
+        pool: Optional[BufferPool] = None,
     ) -> Set[int]:
         """
         Télécharge et décompresse les batches cache depuis R2.
@@ -66,29 +108,52 @@ class ResumeManager:
         """
         restored_frames: Set[int] = set()
         cache_dir.mkdir(parents=True, exist_ok=True)
-
-        for key in batch_keys:
-            try:
-                resp = self._s3.get_object(Bucket=self._bucket, Key=key)
-                data = resp['Body'].read()
-                logger.info(f"Batch téléchargé : {key} ({format_bytes(len(data))})")
-
-                # Décompresser dans le cache_dir
-                extracted = decompress_batch(data, cache_dir, dict_manager)
-                logger.info(f"  → {len(extracted)} fichiers extraits")
-
-                # Extraire les numéros de frame depuis les métadonnées
-                metadata = resp.get('Metadata', {})
-                frames_str = metadata.get('frames', '')
-                if frames_str:
-                    for f in frames_str.split(','):
+        if pool is None:
+            # Un tampon par batch de la fenêtre glissante
+            pool = BufferPool(DOWNLOAD_BUFFER_SIZE, DOWNLOAD_WORKERS * 2)
+
+        # Fenêtre glissante : au plus 2 × DOWNLOAD_WORKERS batches en mémoire
+        # pendant que le thread courant décompresse dans l'ordre
+        keys = iter(batch_keys)
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="Resume") as executor:
+            pending = deque(
+                executor.submit(self._download_one, key, pool)
+                for _, key in zip(range(DOWNLOAD_WORKERS * 2), keys)
+            )
+            while pending:
+                key, data, metadata, buf = pending.popleft().result()
+                next_key = next(keys, None)
+                if next_key is not None:
+                    pending.append(executor.submit(self._download_one, next_key, pool))
+                if data is None:
+                    continue
+
+                try:
+                    # Décompresser dans le cache_dir
+                    extracted = decompress_batch(data, cache_dir, dict_manager)
+                    logger.info(f"  → {len(extracted)} fichiers extraits")
+                    for path in extracted:
                         try:
-                            restored_frames.add(int(f.strip()))
-                        except ValueError:
-                            pass
-
-            except Exception as e:
-                logger.error(f"Erreur téléchargement batch {key} : {e}")
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        self.restored_files[str(path)] = (st.st_size, st.st_mtime_ns)
+
+                    # Extraire les numéros de frame depuis les métadonnées
+                    frames_str = metadata.get('frames', '')
+                    if frames_str:
+                        for f in frames_str.split(','):
+                            try:
+                                restored_frames.add(int(f.strip()))
+                            except ValueError:
+                                pass
+
+                except Exception as e:
+                    logger.error(f"Erreur décompression batch {key} : {e}")
+                finally:
+                    if buf is not None:
+                        data.release()
+                        pool.put(buf)
 
         logger.info(
             f"Reprise terminée : {len(restored_frames)} frames restaurées "
@@ -96,6 +161,41 @@ class ResumeManager:
         )
         return restored_frames
 
+    def _download_one(
+        self,
+        key: str,
+        pool: BufferPool,
+    ) -> Tuple[str, Any, Dict[str, Any], Optional[bytearray]]:
+        """
+        Télécharge un batch : (clé, données ou None si échec, métadonnées,
+        tampon du pool à rendre ou None).
+        """
+        buf: Optional[bytearray] = None
+        try:
+            resp = self._s3.get_object(Bucket=self._bucket, Key=key)
+            body = resp['Body']
+            length = resp.get('ContentLength')
+            # StreamingBody.readinto n'existe que dans les botocore récents
+            if length is None or length > pool.size or not hasattr(body, 'readinto'):
+                data = body.read()
+            else:
+                # Lecture directe dans un tampon du pool (memoryview, sans copie)
+                buf = pool.get()
+                data = memoryview(buf)[:length]
+                read = 0
+                while read < length:
+                    n = body.readinto(data[read:])
+                    if not n:
+                        raise IOError(f"réponse tronquée ({read}/{length} octets)")
+                    read += n
+            logger.info(f"Batch téléchargé : {key} ({format_bytes(len(data))})")
+            return key, data, resp.get('Metadata', {}), buf
+        except Exception as e:
+            if buf is not None:
+                pool.put(buf)
+            logger.error(f"Erreur téléchargement batch {key} : {e}")
+            return key, None, {}, None
+
     def download_blend(self, blend_key: str, output_path: Path) -> bool:
         """Télécharge le fichier .blend depuis R2."""
         try:
@@ -5,12 +5,16 @@ Point d'entrée principal du script VM — Pipeline 3 threads.
 
 import asyncio
 import logging
+import shutil
 import sys
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from http.client import HTTPException, IncompleteRead
+from urllib.request import Request, urlopen
 from urllib.error import URLError
-from typing import Optional, Dict, Set
+from typing import Awaitable, Callable, Optional, Dict, Set, Tuple
 
-from config import Config
+from config import Config, S3Credentials
 from utils import setup_logging
 from ws_client import WSClient
 from pipeline import Pipeline
@@ -20,6 +24,9 @@ from blender_runner import BlenderRunner
 
 logger = logging.getLogger(__name__)
 
+# Tentatives de téléchargement du .blend (reprise par Range après coupure)
+DOWNLOAD_ATTEMPTS = 3
+
 ws_client: Optional[WSClient] = None
 pipeline: Optional[Pipeline] = None
 blender_runner: Optional[BlenderRunner] = None
@@ -27,7 +34,19 @@ heartbeat_task: Optional[asyncio.Task] = None
 shutdown_event = asyncio.Event()
 _blender_done_event = asyncio.Event()
 
-s3_credentials: Optional[Dict] = None
+# Messages attendus avant le démarrage du pipeline
+_s3_ready = asyncio.Event()
+_resume_ready = asyncio.Event()
+CREDENTIALS_TIMEOUT = 30.0
+# RESUME_INFO n'est pas envoyé pour une première exécution : attente bornée
+RESUME_INFO_GRACE = 2.0
+
+# Exécuteurs dédiés : le téléchargement et la finalisation ne se disputent
+# pas l'exécuteur par défaut
+_download_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Download")
+_finalize_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Finalize")
+
+s3_credentials: Optional[S3Credentials] = None
 resume_data: Optional[Dict] = None
 
 
@@ -49,34 +68,32 @@ async def on_authenticated(message: dict):
 
 
 async def on_message(message: dict):
-    global s3_credentials, resume_data
-    msg_type = message.get('type')
-
-    if msg_type == 'S3_CREDENTIALS':
-        s3_credentials = {
-            'endpoint': message.get('endpoint'),
-            'bucket': message.get('bucket'),
-            'region': message.get('region'),
-            'accessKeyId': message.get('accessKeyId'),
-            'secretAccessKey': message.get('secretAccessKey'),
-            'cachePrefix': message.get('cachePrefix', 'cache/'),
-        }
-        logger.info(f"Credentials S3 reçues (prefix={s3_credentials['cachePrefix']})")
-
-    elif msg_type == 'RESUME_INFO':
-        resume_data = message
-        logger.info(
-            f"RESUME_INFO: {len(message.get('securedFrames', []))} frames sécurisées, "
-            f"reprendre à frame {message.get('resumeFromFrame', 1)}"
-        )
+    handler = _MESSAGE_HANDLERS.get(message.get('type'))
+    if handler:
+        await handler(message)
 
-    elif msg_type == 'BLEND_FILE_URL':
-        await handle_blend_file_url(message)
 
-    elif msg_type == 'TERMINATE':
-        reason = message.get('reason', 'Non spécifié')
-        logger.warning(f"Demande de terminaison: {reason}")
-        await shutdown()
+async def handle_s3_credentials(message: dict):
+    global s3_credentials
+    s3_credentials = S3Credentials.from_message(message)
+    logger.info(f"Credentials S3 reçues (prefix={s3_credentials.cache_prefix})")
+    _s3_ready.set()
+
+
+async def handle_resume_info(message: dict):
+    global resume_data
+    resume_data = message
+    _resume_ready.set()
+    logger.info(
+        f"RESUME_INFO: {len(message.get('securedFrames', []))} frames sécurisées, "
+        f"reprendre à frame {message.get('resumeFromFrame', 1)}"
+    )
+
+
+async def handle_terminate(message: dict):
+    reason = message.get('reason', 'Non spécifié')
+    logger.warning(f"Demande de terminaison: {reason}")
+    await shutdown()
 
 
 async def handle_blend_file_url(message: dict):
@@ -87,30 +104,63 @@ async def handle_blend_file_url(message: dict):
     logger.info("Téléchargement .blend...")
     try:
         loop = asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, _download_url, url)
+        await loop.run_in_executor(_download_executor, _download_url, url, Config.BLEND_FILE)
 
-        Config.BLEND_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(Config.BLEND_FILE, 'wb') as f:
-            f.write(data)
-
-        logger.info(f"Fichier .blend sauvegardé ({len(data)} bytes)")
+        logger.info(f"Fichier .blend sauvegardé ({Config.BLEND_FILE.stat().st_size} bytes)")
         asyncio.create_task(start_pipeline())
 
     except Exception as e:
         logger.error(f"Erreur téléchargement .blend: {e}")
 
 
-def _download_url(url: str) -> bytes:
-    try:
-        with urlopen(url, timeout=300) as response:
-            return response.read()
-    except URLError as e:
-        raise RuntimeError(f"Erreur téléchargement: {e}")
+# Type de message → traitement (une seule recherche par message)
+_MESSAGE_HANDLERS: Dict[str, Callable[[dict], Awaitable[None]]] = {
+    'S3_CREDENTIALS': handle_s3_credentials,
+    'RESUME_INFO': handle_resume_info,
+    'BLEND_FILE_URL': handle_blend_file_url,
+    'TERMINATE': handle_terminate,
+}
+
+
+def _download_url(url: str, dest: Path) -> None:
+    # Copie en flux par blocs de 1 Mo : jamais le .blend entier en mémoire
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    with open(dest, 'wb') as f:
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            # Après une coupure : reprendre là où on s'est arrêté
+            have = f.tell()
+            headers = {'Range': f'bytes={have}-'} if have else {}
+            try:
+                with urlopen(Request(url, headers=headers), timeout=300) as response:
+                    if have and response.status != 206:
+                        # Range non supporté : repartir de zéro
+                        f.seek(0)
+                        f.truncate()
+                    start = f.tell()
+                    shutil.copyfileobj(response, f, 1 << 20)
+                    # read() ne lève pas d'erreur sur une réponse tronquée
+                    expected = response.headers.get('Content-Length')
+                    received = f.tell() - start
+                    if expected is not None and received < int(expected):
+                        raise IncompleteRead(b'', int(expected) - received)
+                return
+            except (URLError, HTTPException, OSError) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise RuntimeError(f"Erreur téléchargement: {e}")
+                logger.warning(
+                    f"Téléchargement interrompu à {f.tell()} octets ({e}), "
+                    f"reprise ({attempt}/{DOWNLOAD_ATTEMPTS})"
+                )
 
 
 async def start_pipeline():
     global pipeline, blender_runner
-    await asyncio.sleep(2.0)
+    # Démarrer dès que les messages sont arrivés (au lieu d'un délai fixe)
+    for event, timeout in ((_s3_ready, CREDENTIALS_TIMEOUT), (_resume_ready, RESUME_INFO_GRACE)):
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
     if s3_credentials is None:
         logger.error("Pas de credentials S3 reçues — impossible de démarrer")
@@ -123,6 +173,7 @@ async def start_pipeline():
         already_secured: Set[int] = set()
         total_frames = 250
         dict_bytes: Optional[bytes] = None
+        restored_files: Dict[str, Tuple[int, int]] = {}
 
         if resume_data:
             already_secured = set(resume_data.get('securedFrames', []))
@@ -144,6 +195,7 @@ async def start_pipeline():
                         dict_mgr.load_from_bytes(dict_bytes)
                     restored = resume_mgr.download_batches(batch_keys, Config.CACHE_DIR, dict_mgr)
                     already_secured.update(restored)
+                    restored_files = resume_mgr.restored_files
 
         loop = asyncio.get_event_loop()
 
@@ -154,6 +206,7 @@ async def start_pipeline():
             total_frames=total_frames,
             already_secured=already_secured,
             dict_bytes=dict_bytes,
+            restored_files=restored_files,
         )
         pipeline.start()
 
@@ -162,7 +215,7 @@ async def start_pipeline():
         logger.info(f"Blender terminé (code: {return_code})")
 
         if pipeline:
-            await loop.run_in_executor(None, pipeline.finalize)
+            await loop.run_in_executor(_finalize_executor, pipeline.finalize)
 
         if ws_client and ws_client.is_connected():
             await ws_client.send_ready_to_terminate()
@@ -176,6 +229,9 @@ async def start_pipeline():
 
 
 async def shutdown():
+    # Un seul arrêt : signaux répétés, TERMINATE et main() peuvent se cumuler
+    if shutdown_event.is_set():
+        return
     logger.info("Arrêt en cours...")
     shutdown_event.set()
 
@@ -200,6 +256,11 @@ async def shutdown():
     logger.info("Arrêt terminé")
 
 
+def _on_signal():
+    if not shutdown_event.is_set():
+        asyncio.create_task(shutdown())
+
+
 async def main():
     global ws_client
     setup_logging(logging.INFO)
@@ -212,7 +273,7 @@ async def main():
         try:
             import signal
             for sig in (signal.SIGINT, signal.SIGTERM):
-                loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown()))
+                loop.add_signal_handler(sig, _on_signal)
         except (NotImplementedError, AttributeError):
             pass
 
@@ -237,5 +298,9 @@ async def main():
 
 
 if __name__ == '__main__':
-    exit_code = asyncio.run(main())
+    try:
+        import uvloop  # optionnel : boucle d'événements libuv
+    except ImportError:
+        uvloop = None
+    exit_code = uvloop.run(main()) if uvloop else asyncio.run(main())
     sys.exit(exit_code)
\ No newline at end of file
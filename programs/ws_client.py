@@ -7,10 +7,16 @@ import asyncio
 import json
 import logging
 import time
-from typing import Callable, Optional, Any, Dict
+from collections import deque
+from typing import Callable, Optional, Any, Deque, Dict, List
 import websockets
 from websockets.client import WebSocketClientProtocol
 
+try:
+    import orjson  # optionnel : sérialisation JSON en C
+except ImportError:
+    orjson = None
+
 from config import Config
 
 logger = logging.getLogger(__name__)
@@ -18,6 +24,22 @@ logger = logging.getLogger(__name__)
 PROTOCOL_VERSION = 2
 
 
+if orjson is not None:
+    def _dumps(message: dict) -> str:
+        # Trames texte pour le serveur : décoder le bytes renvoyé par orjson
+        return orjson.dumps(message).decode('utf-8')
+
+    _loads = orjson.loads
+else:
+    _dumps = json.dumps
+    _loads = json.loads
+
+# Messages de contrôle constants : sérialisés une seule fois
+_HEARTBEAT_FRAME = _dumps({'type': 'ALIVE'})
+_CACHE_COMPLETE_FRAME = _dumps({'type': 'CACHE_COMPLETE'})
+_READY_TO_TERMINATE_FRAME = _dumps({'type': 'READY_TO_TERMINATE'})
+
+
 class WSClient:
     def __init__(self, url: str, password: str):
         self.url = url
@@ -27,6 +49,8 @@ class WSClient:
         self.reconnect_attempts = 0
         self.is_running = False
         self.is_authenticated = False
+        # ws ouvert et authentifié : mis à jour aux transitions d'état
+        self._connected = False
 
         self.on_authenticated: Optional[Callable] = None
         self.on_message: Optional[Callable[[dict], Any]] = None
@@ -36,9 +60,16 @@ class WSClient:
         self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._server_time_delta_ms: int = 0
 
+        # Messages des threads du pipeline (deque : append thread-safe sans
+        # verrou), vidés par une seule tâche réveillée via _outbox_ready
+        self._outbox: Deque[dict] = deque()
+        self._outbox_ready = asyncio.Event()
+        self._outbox_signaled = False
+
     async def connect(self):
         self.is_running = True
         self._loop = asyncio.get_running_loop()
+        drain_task = self._loop.create_task(self._drain_outbox())
 
         while self.is_running:
             try:
@@ -49,7 +80,10 @@ class WSClient:
                     ping_interval=20,
                     ping_timeout=20,
                     close_timeout=10,
-                    max_size=10 * 1024 * 1024
+                    max_size=10 * 1024 * 1024,
+                    # Petits messages JSON : permessage-deflate coûte plus de
+                    # CPU sur la boucle qu'il ne fait gagner en octets
+                    compression=None,
                 ) as ws:
                     self.ws = ws
                     self.reconnect_attempts = 0
@@ -57,6 +91,8 @@ class WSClient:
 
                     await self.authenticate()
                     await self.receive_loop()
+                    # Réception terminée : ne plus se dire connecté pendant la fermeture
+                    self._connected = False
 
             except (websockets.exceptions.ConnectionClosed, OSError) as e:
                 logger.warning(f"Connexion fermée/perdue: {e}")
@@ -66,6 +102,7 @@ class WSClient:
                     self.on_error(e)
 
             self.is_authenticated = False
+            self._connected = False
 
             if self.is_running:
                 self.reconnect_attempts += 1
@@ -73,6 +110,7 @@ class WSClient:
                 logger.info(f"Reconnexion dans {delay}s (tentative {self.reconnect_attempts})")
                 await asyncio.sleep(delay)
 
+        drain_task.cancel()
         if self.on_disconnected:
             self.on_disconnected()
 
@@ -81,7 +119,7 @@ class WSClient:
         await self.send({
             'type': 'AUTH',
             'password': self.password,
-            'timestamp': int(time.time() * 1000),
+            'timestamp': time.time_ns() // 1_000_000,
             'protocolVersion': PROTOCOL_VERSION,
         })
         await self._wait_for_auth_response()
@@ -89,15 +127,16 @@ class WSClient:
     async def _wait_for_auth_response(self):
         try:
             response = await asyncio.wait_for(self.ws.recv(), timeout=30.0)
-            message = json.loads(response)
+            message = _loads(response)
 
             if message.get('type') == 'AUTH_SUCCESS':
                 self.token = message.get('token')
                 self.is_authenticated = True
+                self._connected = True
 
                 server_time = int(message.get('serverTime') or 0)
                 if server_time > 0:
-                    local_time = int(time.time() * 1000)
+                    local_time = time.time_ns() // 1_000_000
                     self._server_time_delta_ms = server_time - local_time
 
                 logger.info(f"Authentifié (token: {self.token[:8]}..., proto={message.get('protocolVersion')})")
@@ -116,8 +155,12 @@ class WSClient:
         while self.is_running and self.ws:
             try:
                 message_str = await self.ws.recv()
-                message = json.loads(message_str)
+                message = _loads(message_str)
                 await self.handle_message(message)
+            except json.JSONDecodeError as e:
+                # Message illisible : l'ignorer sans trace (ni reconnexion)
+                logger.warning(f"Message invalide ignoré : {e}")
+                continue
             except websockets.exceptions.ConnectionClosed:
                 break
             except Exception as e:
@@ -135,37 +178,67 @@ class WSClient:
             await self.on_message(message)
 
     async def send(self, message: dict) -> bool:
+        if not self.ws or not self.is_running:
+            return False
+        return await self._send_raw(_dumps(message))
+
+    async def _send_raw(self, frame: str) -> bool:
+        """Envoie un message déjà sérialisé."""
         if not self.ws or not self.is_running:
             return False
         try:
-            await self.ws.send(json.dumps(message))
+            await self.ws.send(frame)
             return True
         except Exception as e:
             logger.debug(f"Erreur send(): {e}")
             return False
 
     def send_threadsafe(self, message: dict) -> bool:
-        if not self._loop or not self.is_running:
-            return False
-        try:
-            asyncio.run_coroutine_threadsafe(self.send(message), self._loop)
-            return True
-        except Exception as e:
-            logger.debug(f"Erreur send_threadsafe(): {e}")
+        return self.send_many_threadsafe([message])
+
+    def send_many_threadsafe(self, messages: List[dict]) -> bool:
+        """
+        Envoie plusieurs messages, dans l'ordre, depuis un autre thread.
+        Les messages s'accumulent dans une file : un seul réveil de la boucle
+        tant que la tâche de vidage ne l'a pas pris en compte.
+        """
+        if not messages or not self._loop or not self.is_running:
             return False
+        self._outbox.extend(messages)
+        if not self._outbox_signaled:
+            self._outbox_signaled = True
+            try:
+                self._loop.call_soon_threadsafe(self._outbox_ready.set)
+            except RuntimeError as e:
+                # Boucle fermée
+                logger.debug(f"Erreur send_many_threadsafe(): {e}")
+                return False
+        return True
+
+    async def _drain_outbox(self):
+        outbox = self._outbox
+        while True:
+            await self._outbox_ready.wait()
+            self._outbox_ready.clear()
+            # Remis à zéro avant de vider : un message ajouté ensuite
+            # redéclenche un réveil
+            self._outbox_signaled = False
+            while outbox:
+                await self.send(outbox.popleft())
 
     async def send_heartbeat(self):
-        return await self.send({'type': 'ALIVE'})
+        return await self._send_raw(_HEARTBEAT_FRAME)
 
     async def send_cache_complete(self):
-        return await self.send({'type': 'CACHE_COMPLETE'})
+        return await self._send_raw(_CACHE_COMPLETE_FRAME)
 
     async def send_ready_to_terminate(self):
-        return await self.send({'type': 'READY_TO_TERMINATE'})
+        return await self._send_raw(_READY_TO_TERMINATE_FRAME)
 
     def disconnect(self):
         logger.info("Déconnexion...")
         self.is_running = False
+        self._connected = False
         if self.ws and self._loop:
             try:
                 asyncio.run_coroutine_threadsafe(self.ws.close(), self._loop)
@@ -173,4 +246,4 @@ class WSClient:
                 pass
 
     def is_connected(self) -> bool:
-        return self.ws is not None and self.is_authenticated
\ No newline at end of file
+        return self._connected
\ No newline at end of file